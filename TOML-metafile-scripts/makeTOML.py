@@ -23,7 +23,7 @@ layout = [[[sg.Text("Create processing TOML file for photometry analysis", font=
         [sg.Text("Bandpass bandwidth for hilbert"), sg.InputText(key="Bandpass bandwidth for hilbert")],
         [sg.Text("Sampling frequency"), sg.InputText(key="Sampling frequency")],
         [sg.Text("Downsampling frequency"), sg.InputText(key="Downsampling frequency")],
-        [sg.Text("Transform type"), sg.InputCombo(["spectrogram", "hilbert"], size=(10, 1), key="Transform type")],
+        [sg.Text("Transform type"), sg.InputCombo(["spectrogram", "single_bin", "hilbert"], size=(10, 1), key="Transform type")],
         [sg.Text("no per segment"), sg.InputText(key="no per segment")],
         [sg.Text("carrier freq - green channel"), sg.InputText(key="carrier freq - green channel")],
         [sg.Text("carrier freq - red channel"), sg.InputText(key="carrier freq - red channel")],
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+clock_map = pytest.importorskip("workflow.utils.clock_map")
+demodulation = pytest.importorskip("workflow.utils.demodulation")
+
+
+def test_segment_clock_follows_spectrogram_segments():
+    # 6103.5 Hz raw data with 216/108 segments gives 56.5 Hz traces, not the 200 Hz behavior rate
+    fs, nperseg, noverlap, behavior_offset = 6103.515625, 216, 108, 7
+    x = np.random.default_rng(0).normal(size=int(2e4))
+    _, t, power = demodulation.single_bin_spectrogram(
+        x, np.array([211.0]), fs, "hamming", nperseg, noverlap
+    )
+    sample_index, session_clock = clock_map.segment_clock(
+        nperseg, noverlap, fs, first_segment=behavior_offset
+    )
+
+    segments = np.arange(power.shape[-1])
+    session_start = behavior_offset * (nperseg - noverlap) / fs
+    np.testing.assert_allclose(
+        clock_map.to_session_clock(segments, sample_index, session_clock),
+        t - session_start,
+        atol=1e-12,
+    )
+    np.testing.assert_allclose(
+        clock_map.to_sample_index(t - session_start, sample_index, session_clock), segments, atol=1e-9
+    )
+    assert np.diff(session_clock) == pytest.approx((nperseg - noverlap) / fs)
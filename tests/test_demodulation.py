@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+demodulation = pytest.importorskip("workflow.utils.demodulation")
+
+
+def _carrier_snippet(carrier_fs, fs=6103.515625, n=int(1e4), noise=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    t = (np.arange(n) + 60 * fs) / fs
+    x = 1.3 * np.sin(2 * np.pi * carrier_fs * t + 0.7) + 0.2 + noise * rng.normal(size=n)
+    return x, t
+
+
+@pytest.mark.parametrize("true_fs", [210.499, 211.5, 213.0, 220.0])
+def test_fit_reference_mismatched_expected_fs(true_fs):
+    x, t = _carrier_snippet(true_fs)
+    params, fit, ref = demodulation.fit_reference(x, t, expected_fs=211.0)
+    fmin_params, fmin_fit, _ = demodulation.fit_reference(x, t, expected_fs=211.0, method="fmin")
+
+    assert abs(params[1] - true_fs) < 0.01
+    assert np.sum((ref - fit) ** 2) <= np.sum((ref - fmin_fit) ** 2) * (1 + 1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_demodulate_keeps_working_dtype(dtype):
+    fs = 6103.515625
+    x, t = _carrier_snippet(211.0, fs=fs, n=int(2e4))
+    ref_x = np.sin(2 * np.pi * 211.0 * t)
+    ref_y = np.cos(2 * np.pi * 211.0 * t)
+    int_x, int_y, r, _ = demodulation.demodulate(
+        x, 211.0, ref_x=ref_x, ref_y=ref_y, fs=fs, dtype=dtype
+    )
+
+    assert int_x.dtype == int_y.dtype == r.dtype == dtype
+    assert demodulation.downsample(x.astype(dtype), fs, 500).dtype == dtype
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_process_trace_unequal_lengths(n_workers):
+    # e.g. Fi1r and Fi2r stores of different lengths demodulated in one batch
+    fs, carriers = 6103.515625, [211.0, 311.0]
+    raw = [_carrier_snippet(f, fs=fs, n=n, seed=i)[0]
+           for i, (f, n) in enumerate(zip(carriers, [100000, 100500]))]
+    _, _, t_list, spect_power_list = demodulation.process_trace(
+        raw, carriers, fs, 2000, 216, 108, groups=[0, 1], n_workers=n_workers
+    )
+    (variant_power_list,) = demodulation.process_trace_variants(
+        raw, carriers, fs,
+        [{"window1": 2000, "num_perseg": 216, "n_overlap": 108, "method": "spectrogram"}],
+        groups=[0, 1],
+    )
+
+    for i in range(len(raw)):
+        _, _, t, spect_power = demodulation.process_trace([raw[i]], [carriers[i]], fs, 2000, 216, 108)
+        np.testing.assert_allclose(spect_power_list[i], spect_power[0])
+        np.testing.assert_allclose(variant_power_list[i], spect_power[0])
+        np.testing.assert_allclose(t_list[i], t[0])
+    assert len(spect_power_list[0]) < len(spect_power_list[1])
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+pp = pytest.importorskip("workflow.utils.photometry_preprocessing")
+
+
+@pytest.mark.parametrize("photo_offset", [0, 5])
+def test_resample_by_trial_identity_at_equal_rates(photo_offset):
+    behavior_starts = np.array([0, 100, 250, 400])
+    photo_values = np.random.default_rng(0).normal(size=(410, 2))
+
+    resampled = pp.resample_by_trial(photo_values, behavior_starts + photo_offset, behavior_starts)
+
+    np.testing.assert_allclose(
+        resampled, photo_values[photo_offset : photo_offset + 400], rtol=0, atol=1e-12
+    )
+    np.testing.assert_allclose(
+        pp.resample_by_trial(photo_values[:, 0], behavior_starts + photo_offset, behavior_starts),
+        resampled[:, 0],
+    )
@@ -24,4 +24,29 @@ dj.config['custom']['processed_root_data_dir'] = os.getenv(
     'PROCESSED_ROOT_DATA_DIR',
     dj.config['custom'].get('processed_root_data_dir', ''))
 
+dj.config['custom']['demodulation.n_workers'] = int(os.getenv(
+    'DEMODULATION_N_WORKERS',
+    dj.config['custom'].get('demodulation.n_workers', 1)))
+
+# 0 uses half of the worker's memory limit
+dj.config['custom']['demodulation.memory_budget_gb'] = float(os.getenv(
+    'DEMODULATION_MEMORY_BUDGET_GB',
+    dj.config['custom'].get('demodulation.memory_budget_gb', 0)))
+
+dj.config['custom']['raw_cache.enabled'] = str(os.getenv(
+    'RAW_CACHE_ENABLED',
+    dj.config['custom'].get('raw_cache.enabled', False))).lower() in ('1', 'true', 'yes')
+
+dj.config['custom']['raw_cache.max_size_gb'] = float(os.getenv(
+    'RAW_CACHE_MAX_SIZE_GB',
+    dj.config['custom'].get('raw_cache.max_size_gb', 100)))
+
+dj.config['custom']['stage_cache.enabled'] = str(os.getenv(
+    'STAGE_CACHE_ENABLED',
+    dj.config['custom'].get('stage_cache.enabled', False))).lower() in ('1', 'true', 'yes')
+
+dj.config['custom']['stage_cache.max_size_gb'] = float(os.getenv(
+    'STAGE_CACHE_MAX_SIZE_GB',
+    dj.config['custom'].get('stage_cache.max_size_gb', 50)))
+
 db_prefix = dj.config["custom"].get("database.prefix", "")
\ No newline at end of file
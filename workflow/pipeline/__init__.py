@@ -5,4 +5,5 @@ from .dlc import model, train
 from .event import event, trial
 from .ephys import ephys, probe
 from . import photometry
+from . import sync
 from . import ingestion
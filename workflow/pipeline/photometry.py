@@ -4,20 +4,17 @@ import pandas as pd
 import numpy as np
 import warnings
 from pathlib import Path
-import tomli
-import tdt
-import pymatreader
 import scipy.io as spio
 from scipy import signal
 from scipy.fft import fft, ifft, rfft
-from copy import deepcopy
 
-from element_interface.utils import find_full_path
+from element_interface.utils import find_full_path, dict_to_uuid
 from workflow import db_prefix
 from workflow.pipeline import session, subject, lab, reference
 from workflow.utils.paths import get_raw_root_data_dir
 import workflow.utils.photometry_preprocessing as pp
-from workflow.utils import demodulation
+from workflow.utils import demodulation, photometry_io, raw_cache
+from workflow.utils.meta_info import COLOR_MAPPING, load_meta_info
 
 
 logger = dj.logger
@@ -63,6 +60,60 @@ class CarrierFrequency(dj.Lookup):
     """
 
 
+@schema
+class DemodulationParamSet(dj.Lookup):
+    definition = """ # processing parameters overriding a session's .toml Processing_Parameters
+    paramset_idx        : smallint
+    ---
+    paramset_desc       : varchar(128)
+    param_set_hash      : uuid
+    unique index (param_set_hash)
+    params              : longblob  # e.g. {"transform": "single_bin", "no_per_segment": 432}
+    """
+
+    @classmethod
+    def insert_new_params(cls, paramset_desc: str, params: dict, paramset_idx: int = None):
+        if params.get("transform", "spectrogram") not in ("spectrogram", "single_bin"):
+            raise ValueError(
+                f"Parameter sets support the spectrogram and single_bin transforms, not {params['transform']}"
+            )
+        if paramset_idx is None:
+            paramset_idx = (dj.U().aggr(cls, n="max(paramset_idx)").fetch1("n") or 0) + 1
+
+        param_dict = {
+            "paramset_idx": paramset_idx,
+            "paramset_desc": paramset_desc,
+            "params": params,
+            "param_set_hash": dict_to_uuid(params),
+        }
+        param_query = cls & {"param_set_hash": param_dict["param_set_hash"]}
+
+        if param_query:  # If the specified param-set already exists
+            existing_paramset_idx = param_query.fetch1("paramset_idx")
+            if existing_paramset_idx == paramset_idx:  # If the existing set has the same paramset_idx: job done
+                return
+            else:  # If not same name: human error, trying to add the same paramset with different name
+                raise dj.DataJointError(
+                    f"The specified param-set already exists"
+                    f" - with paramset_idx: {existing_paramset_idx}"
+                )
+        else:
+            if {"paramset_idx": paramset_idx} in cls.proj():
+                raise dj.DataJointError(
+                    f"The specified paramset_idx {paramset_idx} already exists,"
+                    f" please pick a different one."
+                )
+            cls.insert1(param_dict)
+
+
+@schema
+class DemodulationTask(dj.Manual):
+    definition = """ # parameter sets to demodulate a session with, in addition to its .toml
+    -> session.Session
+    -> DemodulationParamSet
+    """
+
+
 @schema
 class FiberPhotometry(dj.Imported):
     definition = """
@@ -96,796 +147,226 @@ class FiberPhotometry(dj.Imported):
         """
 
     def make(self, key):
-        
+
         # Find data dir
-        #first determine data type e.g. raw matlab, processed matlab, or tdt
         session_dir = (session.SessionDirectory & key).fetch1("session_dir")
         session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
         photometry_dir = session_full_dir / "Photometry"
 
-        # Read from the meta_info.toml in the photometry folder if exists
-        meta_info_file = list(photometry_dir.glob("*.toml"))[0]
-        meta_info = {}
-        try:
-            with open(meta_info_file, "rb") as f:
-                meta_info = tomli.load(f)
-        except FileNotFoundError:
-            logger.info("meta info is missing")
-        light_source_name = meta_info.get("Fiber", {}).get("light_source", "")
-
-        # Scan directory for data format
-        # If there is a .tdt file, then it is a tdt data and enter tdt_data mode
-        # If there is a data*.mat file, then it is a matlab data and enter matlab_data mode
-        # If there is a timeseries2.mat file, then it is demux matlab data and enter demux_matlab_data mode  
-        if len(list(photometry_dir.glob("data*.mat"))) > 0:
-            data_format = "matlab_data"
-            matlab_data: dict = spio.loadmat(
-            next(photometry_dir.glob("data*.mat")), simplify_cells=True)
-            matlab_data=matlab_data["data"]
-        elif len(list(photometry_dir.glob("*timeseries*.mat"))) > 0:
-            data_format = "demux_matlab_data"
-            try:
-                demux_matlab_data: list[dict] = spio.loadmat(
-                    next(photometry_dir.glob("*timeseries*.mat")), simplify_cells=True
-                )["timeSeries"]
-            except NotImplementedError:
-                # If scipy throws a NotImplementedError, use pymatreader for MATLAB v7.3 files
-                data_format = "demux_matlab_data_mat73"
-                photometry_file = next(photometry_dir.glob("*timeseries*.mat"))
-                data_dict = pymatreader.read_mat(photometry_file)
-                demux_matlab_data = data_dict["timeSeries"]
-        elif len(list(photometry_dir.glob("*.t*"))) > 0:
-            data_format = "tdt_data"
-            tdt_data: tdt.StructType = tdt.read_block(photometry_dir)      
-        
-        ## Enter into different data format mode
-        if data_format == "matlab_data":
-            #matlab_data
-            raw_sample_rate = meta_info.get("Processing_Parameters").get("sampling_frequency")
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = matlab_data[trace_indices.get("right").get("carrier_g", None)]
-            carrier_r_right =matlab_data[trace_indices.get("right").get("carrier_r", None)]
-            photom_g_right = matlab_data[trace_indices.get("right").get("photom_g", None)]
-            photom_r_right = matlab_data[trace_indices.get("right").get("photom_r", None)]
-            carrier_g_left = matlab_data[trace_indices.get("left").get("carrier_g", None)]
-            carrier_r_left = matlab_data[trace_indices.get("left").get("carrier_r", None)]
-            photom_g_left = matlab_data[trace_indices.get("left").get("photom_g", None)]
-            photom_r_left = matlab_data[trace_indices.get("left").get("photom_r", None)]
-
-            raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                         photom_g_left, photom_r_left]
-            raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                            carrier_g_left, carrier_r_left]
-
-            # Get processing parameters
-            processing_parameters = meta_info.get("Processing_Parameters")
+        # Read the meta_info.toml in the photometry folder, malformed files
+        # are rejected here before any raw data is read
+        meta = load_meta_info(photometry_dir)
+        processing_parameters = meta.processing_parameters
+        sampling_Hz = meta.sampling_frequency
+        n_workers, memory_budget = _demodulation_resources()
+
+        # Every data format is read by its reader into the channels of the channel
+        # table (fiber x color x role) built from Signal_Indices:
+        # raw (modulated) formats are then demodulated photodetector by photodetector,
+        # demodulated (demux) formats are ingested as they are
+        data_format = _photometry_data_format(photometry_dir)
+        if data_format in _RAW_READERS:
+            if data_format == "tdt_data" and meta.transform == "hilbert":
+                raise NotImplementedError(
+                    "Hilbert demodulation of TDT blocks is not supported, use the "
+                    "spectrogram or single_bin transform"
+                )
+            sources, read = _RAW_READERS[data_format](photometry_dir, meta)
+            plan = _plan_raw_channels(meta, sources, read)
+            carriers = {entry["pair"]: entry["carrier_frequency"] for entry in plan}
+            batches = _demodulate_raw_batches(
+                meta, plan, read, n_workers=n_workers, memory_budget=memory_budget
+            )
             beh_synch_signal = processing_parameters.get("behavior_offset", 0)
-            window = processing_parameters.get("z_window", 60)
-            #process_z = processing_parameters.get("z", False)
-            set_carrier_g_right = processing_parameters.get("left").get("carrier_frequency_g", 0)
-            set_carrier_r_right = processing_parameters.get("left").get("carrier_frequency_r", 0)
-            set_carrier_g_left = processing_parameters.get("right").get("carrier_frequency_g", 0)
-            set_carrier_r_left = processing_parameters.get("right").get("carrier_frequency_r", 0)
-            bp_bw = processing_parameters.get("bandpass_bandwidth", 0.5)
-            sampling_Hz = processing_parameters.get("sampling_frequency", None)
-            downsample_Hz = processing_parameters.get("downsample_frequency", 200)
-            transform = processing_parameters.get("transform", {})
-            num_perseg = processing_parameters.get("no_per_segment", 216)
-            n_overlap = processing_parameters.get("noverlap", 108)
-
-            window1 = round(window * sampling_Hz)
-
-            set_carrier_list: list[dict]=[set_carrier_g_right, set_carrier_r_right,
-                                            set_carrier_g_left, set_carrier_r_left]
-            
-            # Get calculated carrier freqeuncy from matlab_data
-            calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
-            for i in range(len(set_carrier_list)):
-                    if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
-                        warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
-                        set_carrier_list = calc_carry_list
-                    else:
-                        calc_carry_list = calc_carry_list
-            
-            four_list = demodulation.four(raw_photom_list)
-            #demodulate photometry data
-            z1_trace_list, power_spectra_list, t_list, spect_power_list = demodulation.process_trace(
-                                raw_photom_list, calc_carry_list,
-                                sampling_Hz, window1, num_perseg, n_overlap)
-            
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-        # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-            
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    
-                    raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                            photom_g_left, photom_r_left]
-                    raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                                carrier_g_left, carrier_r_left]
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = calc_carry_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = spect_power_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                        
-                    demodulated_trace_list.append(
-                        {
-                            **key,
-                            "fiber_id": side_to_fiber_id_mapping[fiber],
-                            "hemisphere": fiber,
-                            "trace_name": trace_name.split("_")[0],
-                            "emission_color": emission_color,
-                            "sensor_protein_name": sensor_protein,
-                            "excitation_wavelength": excitation_wavelength,
-                            "carrier_frequency": carrier_frequency,
-                            "demod_sample_rate": carrier_frequency,
-                            "trace": demod_trace,
-                        }
-                    )
+        else:
+            demodulated, beh_synch_signal = _DEMUX_READERS[data_format](photometry_dir, meta)
+            carriers = {pair: carrier for pair, (_, carrier) in demodulated.items()}
+            batches = iter([[demodulated]])
+            del demodulated
+
+        # Populate the lookup tables referenced by the traces, one bulk insert per table
+        lookup_rows = {EmissionColor: [], SensorProtein: [], ExcitationWavelength: [],
+                       CarrierFrequency: []}
+        for channel in meta.channels:
+            if (channel.side, channel.color) not in carriers:
+                continue
+            color_info = meta.fibers[channel.side].colors[channel.color]
+            lookup_rows[EmissionColor].append(
+                {"emission_color": COLOR_MAPPING[channel.color],
+                 "wavelength": color_info.emission_wavelength}
+            )
+            if color_info.sensor_protein:
+                lookup_rows[SensorProtein].append(
+                    {"sensor_protein_name": color_info.sensor_protein}
+                )
+            if color_info.excitation_wavelength:
+                lookup_rows[ExcitationWavelength].append(
+                    {"excitation_wavelength": color_info.excitation_wavelength}
+                )
+            if carriers[(channel.side, channel.color)]:
+                lookup_rows[CarrierFrequency].append(
+                    {"carrier_frequency": carriers[(channel.side, channel.color)]}
+                )
+        _insert_lookups(lookup_rows)
+
+        # Populate FiberPhotometry
+        logger.info(f"Populate {__name__}.FiberPhotometry")
+        self.insert1(
+            {
+                **key,
+                "light_source_name": meta.light_source,
+                "raw_sample_rate": sampling_Hz,
+                "beh_synch_signal": beh_synch_signal,
+            }
+        )
 
-            # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
+        # Populate FiberPhotometry.Fiber
+        logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
+        self.Fiber.insert(
+            [
                 {
                     **key,
-                    "light_source_name": light_source_name,
-                    "raw_sample_rate": raw_sample_rate,
-                    "beh_synch_signal": beh_synch_signal,
+                    "fiber_id": fiber.fiber_id,
+                    "hemisphere": side,
+                    "notes": fiber.notes,
                 }
-            )
-
-            # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
+                for side, fiber in meta.fibers.items()
+            ]
+        )
 
-            # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-            
-
-            del matlab_data
-            #matlab_data
-            
-        elif data_format == "demux_matlab_data":
-            #demux_matlab_data
-            
-            raw_sample_rate = None
-            sampling_Hz = meta_info.get("Processing_Parameters").get("sampling_frequency")
-            beh_synch_signal = demux_matlab_data[0]["time_offset"]
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = trace_indices.get("right").get("carrier_g", None)
-            carrier_r_right =trace_indices.get("right").get("carrier_r", None)
-            photom_g_right = trace_indices.get("right").get("photom_g", None)
-            photom_r_right = trace_indices.get("right").get("photom_r", None)
-            carrier_g_left = trace_indices.get("left").get("carrier_g", None)
-            carrier_r_left = trace_indices.get("left").get("carrier_r", None)
-            photom_g_left = trace_indices.get("left").get("photom_g", None)
-            photom_r_left = trace_indices.get("left").get("photom_r", None)
-
-            # Get demodulated sample rate
-            demod_sampling: list[float] = []
-            demod_sampling.append(demux_matlab_data[carrier_g_right]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_r_right]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_g_left]["demux_freq"])
-            demod_sampling.append(demux_matlab_data[carrier_r_left]["demux_freq"])
-                       
-            
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-            # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-                
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-
-                    ##pull out the data from the matlab file
-                    photometry_demux_g_left = demux_matlab_data[photom_g_left]['data']
-                    photometry_demux_r_left = demux_matlab_data[photom_r_left]['data']
-                    photometry_demux_g_right = demux_matlab_data[photom_g_right]['data']
-                    photometry_demux_r_right = demux_matlab_data[photom_r_right]['data']
-                    demux_trace_list: list[dict] = []
-                    demux_trace_list.append(photometry_demux_g_right)
-                    demux_trace_list.append(photometry_demux_r_right)
-                    demux_trace_list.append(photometry_demux_g_left)
-                    demux_trace_list.append(photometry_demux_r_left)
-
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = demod_sampling[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = demux_trace_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                    
-                                    
-                    demodulated_trace_list.append(
-                            {
-                                **key,
-                                "fiber_id": side_to_fiber_id_mapping[fiber],
-                                "hemisphere": fiber,
-                                "trace_name": trace_name.split("_")[0],
-                                "emission_color": emission_color,
-                                "sensor_protein_name": sensor_protein,
-                                "excitation_wavelength": excitation_wavelength,
-                                "carrier_frequency": carrier_frequency,
-                                "demod_sample_rate": carrier_frequency,
-                                "trace": demod_trace,
-                            }
-                        )
-                    
-                # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                        {
-                            **key,
-                            "light_source_name": light_source_name,
-                            "raw_sample_rate": sampling_Hz,
-                            "beh_synch_signal": beh_synch_signal,
-                        }
-                    )
-
-                    # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
-
-                    # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-
-            del demux_matlab_data
-            #demux_matlab_data
-
-        if data_format == "demux_matlab_data_mat73":
-            #demux_matlab_data_mat73
-            
-            raw_sample_rate = None
-            sampling_Hz = meta_info.get("Processing_Parameters").get("sampling_frequency")
-            beh_synch_signal = demux_matlab_data["time_offset"][0]
-
-            #Get index of traces
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = trace_indices.get("right").get("carrier_g", None)
-            carrier_r_right =trace_indices.get("right").get("carrier_r", None)
-            photom_g_right = trace_indices.get("right").get("photom_g", None)
-            photom_r_right = trace_indices.get("right").get("photom_r", None)
-            carrier_g_left = trace_indices.get("left").get("carrier_g", None)
-            carrier_r_left = trace_indices.get("left").get("carrier_r", None)
-            photom_g_left = trace_indices.get("left").get("photom_g", None)
-            photom_r_left = trace_indices.get("left").get("photom_r", None)
-
-            # Get demodulated sample rate
-            demod_sampling: list[float] = []
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_g_right] if carrier_g_right is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_r_right] if carrier_r_right is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_g_left] if carrier_g_left is not None else None)
-            demod_sampling.append(demux_matlab_data["demux_freq"][carrier_r_left] if carrier_r_left is not None else None)
-
-            # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-            # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-                
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r'] if key in trace_names}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    ##pull out the data from the matlab file
-                    photometry_demux_g_left = (demux_matlab_data['data'][photom_g_left] if photom_g_left is not None else None)
-                    photometry_demux_r_left = (demux_matlab_data['data'][photom_r_left] if photom_r_left is not None else None)
-                    photometry_demux_g_right = (demux_matlab_data['data'][photom_g_right] if photom_g_right is not None else None)
-                    photometry_demux_r_right = (demux_matlab_data['data'][photom_r_right] if photom_r_right is not None else None)
-                    demux_trace_list: list[dict] = []
-                    demux_trace_list.append(photometry_demux_g_right)
-                    demux_trace_list.append(photometry_demux_r_right)
-                    demux_trace_list.append(photometry_demux_g_left)
-                    demux_trace_list.append(photometry_demux_r_left)
-
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = demod_sampling[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = demux_trace_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                    
-                                    
-                    demodulated_trace_list.append(
-                            {
-                                **key,
-                                "fiber_id": side_to_fiber_id_mapping[fiber],
-                                "hemisphere": fiber,
-                                "trace_name": trace_name.split("_")[0],
-                                "emission_color": emission_color,
-                                "sensor_protein_name": sensor_protein,
-                                "excitation_wavelength": excitation_wavelength,
-                                "carrier_frequency": carrier_frequency,
-                                "demod_sample_rate": carrier_frequency,
-                                "trace": demod_trace,
-                            }
-                        )
-                    
-                # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
-                        {
-                            **key,
-                            "light_source_name": light_source_name,
-                            "raw_sample_rate": sampling_Hz,
-                            "beh_synch_signal": beh_synch_signal,
-                        }
-                    )
-
-                    # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
-
-                    # Populate FiberPhotometry.DemodulatedTrace
+        # Populate FiberPhotometry.DemodulatedTrace batch by batch, each batch is
+        # inserted and released before the next one is demodulated.
+        # make runs in the populate transaction, so the inserts stay atomic.
+        for (demodulated,) in batches:  # one variant, the .toml Processing_Parameters
             logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
+            self.DemodulatedTrace.insert(_demodulated_trace_rows(key, meta, demodulated))
+            del demodulated
 
-            del demux_matlab_data
-            #demux_matlab_data_mat73
-                
 
+@schema
+class Demodulation(dj.Computed):
+    definition = """ # demodulation of a session with the parameter set of one of its DemodulationTasks
+    -> FiberPhotometry
+    -> DemodulationTask
+    """
 
-        elif data_format == "tdt_data":
-            #tdt_data             
-                        
-            # Get trace indices from meta_info
-            trace_indices = meta_info.get("Signal_Indices")
-            carrier_g_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("carrier_g", None)]
-            carrier_r_right =tdt_data.streams.Fi1r.data[trace_indices.get("right").get("carrier_r", None)]
-            photom_g_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("photom_g", None)]
-            photom_r_right = tdt_data.streams.Fi1r.data[trace_indices.get("right").get("photom_r", None)]
-            carrier_g_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("carrier_g", None)]
-            carrier_r_left = tdt_data.streams.Fi2r.data [trace_indices.get("left").get("carrier_r", None)]
-            photom_g_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("photom_g", None)]
-            photom_r_left = tdt_data.streams.Fi2r.data[trace_indices.get("left").get("photom_r", None)]
-
-            #Get trace names and store in this list for ingestion
-            raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                         photom_g_left, photom_r_left]
-            raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                            carrier_g_left, carrier_r_left]
-
-            
-            # Get processing parameters
-            processing_parameters = meta_info.get("Processing_Parameters")
-            beh_synch_signal = processing_parameters.get("behavior_offset", 0)
-            window = processing_parameters.get("z_window", 60)
-            process_z = processing_parameters.get("z", False)
-            set_carrier_g_right = processing_parameters.get("left").get("carrier_frequency_g", 0)
-            set_carrier_r_right = processing_parameters.get("left").get("carrier_frequency_r", 0)
-            set_carrier_g_left = processing_parameters.get("right").get("carrier_frequency_g", 0)
-            set_carrier_r_left = processing_parameters.get("right").get("carrier_frequency_r", 0)
-            bp_bw = processing_parameters.get("bandpass_bandwidth", 0.5)
-            sampling_Hz = processing_parameters.get("sampling_frequency", None)
-            downsample_Hz = processing_parameters.get("downsample_frequency", 200)
-            demod_sample_rate = processing_parameters.get("demod_sample_rate", 200)
-            transform = processing_parameters.get("transform", {})
-            num_perseg = processing_parameters.get("no_per_segment", 216)
-            n_overlap = processing_parameters.get("noverlap", 108)
-
-            set_carrier_list: list[dict]=[set_carrier_g_right, set_carrier_r_right,
-                                            set_carrier_g_left, set_carrier_r_left]
-            
-            calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
-
-            for i in range(len(set_carrier_list)):
-                    if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
-                        warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
-                        set_carrier_list = calc_carry_list
-            else:
-                    calc_carry_list = calc_carry_list         
-
-            #change window to reflect the sampling rate/downsample rate
-            window1 = round(window * sampling_Hz)
-
-            # Process traces
-            if transform == "spectrogram":
-                calc_carry_list = demodulation.calc_carry(raw_carrier_list, sampling_Hz)
-                for i in range(len(set_carrier_list)):
-                    if calc_carry_list[i] != (set_carrier_list[i] >= calc_carry_list[i]+5 or set_carrier_list[i] <= calc_carry_list[i]-5):
-                        warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
-                        set_carrier_list = calc_carry_list
-                else:
-                    calc_carry_list = calc_carry_list
-
-                four_list = demodulation.four(raw_photom_list)
-                z1_trace_list, power_spectra_list, t_list, spect_power_list = demodulation.process_trace(
-                                raw_photom_list, calc_carry_list,
-                                sampling_Hz, window1, num_perseg, n_overlap)                 
-            elif transform == "hilbert":
-                fiber_to_side_mapping = {1: "right", 2: "left"}
-                color_mapping = {"g": "green", "r": "red", "b": "blue"}
-                synch_signal_names = ["toBehSys", "fromBehSys"]
-                demod_sample_rate = 600
-                photometry_df, fibers, raw_sample_rate = demodulation.offline_demodulation(
-                tdt_data, z=True, tau=0.05, downsample_fs=demod_sample_rate, bandpass_bw=20
+    class Trace(dj.Part):
+        definition = """ # demodulated photometry traces
+        -> master
+        -> FiberPhotometry.Fiber
+        trace_name          : varchar(8)  # (e.g., photom, carrier)
+        -> EmissionColor
+        ---
+        -> [nullable] SensorProtein
+        -> [nullable] ExcitationWavelength
+        -> [nullable] CarrierFrequency
+        demod_sample_rate   : float       # sample rate of the demodulated data (in Hz)
+        trace               : longblob    # demodulated photometry traces
+        """
+
+    def make(self, key):
+
+        # Find data dir
+        session_dir = (session.SessionDirectory & key).fetch1("session_dir")
+        session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
+        photometry_dir = session_full_dir / "Photometry"
+
+        meta = load_meta_info(photometry_dir)
+        data_format = _photometry_data_format(photometry_dir)
+        if data_format not in _RAW_READERS:
+            logger.warning(f"No raw photometry traces for {key}, e.g. demodulated input")
+            return
+
+        # Every pending parameter set of the session is demodulated from one read of the
+        # raw data, populate then skips the other tasks of the session
+        session_key = (FiberPhotometry & key).fetch1("KEY")
+        task_keys = ((DemodulationTask & session_key) - self).fetch("KEY", order_by="paramset_idx")
+        variants = []
+        for task_key in task_keys:
+            # The parameter set overrides the .toml Processing_Parameters
+            params = {**meta.processing_parameters,
+                      **(DemodulationParamSet & task_key).fetch1("params")}
+            if params.get("transform") not in ("spectrogram", "single_bin"):
+                logger.warning(
+                    f"Parameter set {task_key['paramset_idx']} demodulates {session_key} with the "
+                    f"spectrogram transform, the session's {params.get('transform')} transform "
+                    "has no parameter sets"
                 )
+                params["transform"] = "spectrogram"
+            variants.append(params)
+
+        self.insert(task_keys)
+
+        n_workers, memory_budget = _demodulation_resources()
+        sources, read = _RAW_READERS[data_format](photometry_dir, meta)
+        plan = _plan_raw_channels(meta, sources, read)
+        for demodulated_variants in _demodulate_raw_batches(
+            meta, plan, read, variants=variants, n_workers=n_workers, memory_budget=memory_budget
+        ):
+            logger.info(f"Populate {__name__}.Demodulation.Trace")
+            self.Trace.insert(
+                [
+                    row
+                    for task_key, demodulated in zip(task_keys, demodulated_variants)
+                    for row in _demodulated_trace_rows(task_key, meta, demodulated)
+                ]
+            )
+            del demodulated_variants
 
-            #loop through each trace in raw_photom_list and raw_carrier_list
-            #return the demodulated traces
-            
-          
-        # Store data in this list for ingestion
-            fiber_list: list[dict] = []
-            demodulated_trace_list: list[dict] = []
-                   
-            fibers: list[str] = [ "right", "left"]
-
-            side_to_fiber_id_mapping = {"right": 1, "left": 2}
-            color_mapping = {"g": "green", "r": "red", "b": "blue"}
-
-        # Get photometry traces for each fiber
-            for fiber in fibers:
-                 
-                fiber_notes = meta_info.get("Fiber").get("implantation").get(f'{fiber}').get("notes", None)
-                #fiber_diam = meta_info.get("Fiber").get("fiber_diameter", None)
-                #hemisphere = meta_info.get("Experiment").get("hemisphere")
-                fiber_list.append(
-                    {
-                        **key,
-                        "fiber_id": side_to_fiber_id_mapping[fiber],
-                        "hemisphere": fiber,
-                        "notes": fiber_notes,
-                    }
-                    )
-            
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                traceNames = {key: trace_names[key] for key in ['photom_g', 'photom_r', 'carrier_g', 'carrier_r']}
-                trace_names = meta_info.get("Signal_Indices").get(f'{fiber}')
-                for trace_name in traceNames:
-
-
-                    # Populate EmissionColor if present
-                    emission_color = color_mapping[trace_name.split("_")[1][0]]
-
-                    emission_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("emission_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    EmissionColor.insert1(
-                        {
-                            "emission_color": emission_color,
-                            "wavelength": emission_wavelength,
-                        },
-                        skip_duplicates=True,
-                    )
-
-                    # Populate SensorProtein if present
-                    sensor_protein = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}', {})
-                        .get("sensor_protein", {})
-                        .get(emission_color, None)
-                    )
-                    if sensor_protein:
-                        logger.info(
-                            f"{sensor_protein} is inserted into {__name__}.SensorProtein"
-                        )
-                        SensorProtein.insert1(
-                            {"sensor_protein_name": sensor_protein}, skip_duplicates=True
-                        )
-
-                    # Populate ExcitationWavelength if present
-                    excitation_wavelength = (
-                        meta_info.get("Signal_Indices", {})
-                        .get(f'{fiber}')
-                        .get("excitation_wavelength", {})
-                        .get(emission_color, None)
-                    )
-
-                    if excitation_wavelength:
-                        logger.info(
-                            f"{excitation_wavelength} is inserted into {__name__}.ExcitationWavelength"
-                        )
-                        ExcitationWavelength.insert1(
-                            {"excitation_wavelength": excitation_wavelength},
-                            skip_duplicates=True,
-                        )
-                    
-                    raw_photom_list: list[dict]=[photom_g_right, photom_r_right, 
-                                            photom_g_left, photom_r_left]
-                    raw_carrier_list: list[dict]=[carrier_g_right, carrier_r_right,
-                                                carrier_g_left, carrier_r_left]
-                    carrier_ind = {"g_right":0, "r_right":1, "g_left":2, "r_left":3}
-                    carrier_frequency = calc_carry_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    demod_trace = spect_power_list[carrier_ind[trace_name.split("_")[1]+ f"_{fiber}"]]
-
-                    if carrier_frequency:
-                        logger.info(
-                            f"{carrier_frequency} is inserted into {__name__}.CarrierFrequency"
-                        )
-                        CarrierFrequency.insert1(
-                            {"carrier_frequency": carrier_frequency},
-                            skip_duplicates=True,
-                        )
-                        
-                    demodulated_trace_list.append(
-                        {
-                            **key,
-                            "fiber_id": side_to_fiber_id_mapping[fiber],
-                            "hemisphere": fiber,
-                            "trace_name": trace_name.split("_")[0],
-                            "emission_color": emission_color,
-                            "sensor_protein_name": sensor_protein,
-                            "excitation_wavelength": excitation_wavelength,
-                            "carrier_frequency": carrier_frequency,
-                            "demod_sample_rate": carrier_frequency,
-                            "trace": demod_trace,
-                        }
-                    )
-            
-            # Populate FiberPhotometry
-            logger.info(f"Populate {__name__}.FiberPhotometry")
-            self.insert1(
+
+@schema
+class DiagnosticSpectrum(dj.Computed):
+    definition = """ # power spectra of the raw photometry traces for quality control
+    -> FiberPhotometry
+    ---
+    spectrum_nperseg    : int       # Welch segment length (samples)
+    """
+
+    class Trace(dj.Part):
+        definition = """ # decimated power spectrum per fiber and color
+        -> master
+        -> FiberPhotometry.Fiber
+        -> EmissionColor
+        ---
+        frequencies         : longblob  # (Hz)
+        power               : longblob  # power spectral density of the raw trace
+        """
+
+    # Not run by the workers: spectra are only computed when requested through
+    # DiagnosticSpectrum.get (or populate) and are stored from then on
+    nperseg = 2**14
+
+    def make(self, key):
+        traces, sampling_Hz = _load_raw_photometry(key)
+        if not traces:
+            logger.info(f"No raw photometry traces for {key}, e.g. demodulated input")
+
+        fiber_ids = dict(zip(*(FiberPhotometry.Fiber & key).fetch("hemisphere", "fiber_id")))
+        spectrum_list: list[dict] = []
+        for (fiber, emission_color), trace in traces.items():
+            frequencies, power = signal.welch(
+                trace, fs=sampling_Hz, nperseg=min(self.nperseg, len(trace))
+            )
+            spectrum_list.append(
                 {
                     **key,
-                    "light_source_name": light_source_name,
-                    "raw_sample_rate": sampling_Hz,
-                    "beh_synch_signal": beh_synch_signal,
+                    "fiber_id": fiber_ids[fiber],
+                    "hemisphere": fiber,
+                    "emission_color": emission_color,
+                    "frequencies": frequencies.astype(np.float32),
+                    "power": power.astype(np.float32),
                 }
             )
 
-            # Populate FiberPhotometry.Fiber
-            logger.info(f"Populate {__name__}.FiberPhotometry.Fiber")
-            self.Fiber.insert(fiber_list)
+        self.insert1({**key, "spectrum_nperseg": self.nperseg})
+        self.Trace.insert(spectrum_list)
+
+    @classmethod
+    def get(cls, key) -> pd.DataFrame:
+        """Spectra for the sessions in key, computed on first request"""
+        cls.populate(key)
+        return (cls.Trace & key).fetch(format="frame")
 
-            # Populate FiberPhotometry.DemodulatedTrace
-            logger.info(f"Populate {__name__}.FiberPhotometry.DemodulatedTrace")
-            self.DemodulatedTrace.insert(demodulated_trace_list)
-            
-            del tdt_data
-            #tdt_data
 
 @schema
 class FiberPhotometrySynced(dj.Imported):
@@ -913,22 +394,13 @@ class FiberPhotometrySynced(dj.Imported):
         session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
         behavior_dir = session_full_dir / "Behavior"
         # Get meta info
-        meta_info_file = list(behavior_dir.glob("*.toml"))[0]
-        meta_info = {}
-        try:
-            with open(meta_info_file, "rb") as f:
-                meta_info = tomli.load(f)
-        except FileNotFoundError:
-            logger.info("meta info is missing")
-        processing_parameters = meta_info.get("Processing_Parameters")
+        meta = load_meta_info(behavior_dir, require_signals=False)
+        processing_parameters = meta.processing_parameters
         transform = processing_parameters.get("transform", {})
 
         if transform == "hilbert":
 
             # Parameters
-            get_fiber_id = (
-                lambda side: 1 if side.lower().startswith("r") else 2
-            )  # map hemisphere to fiber id
             get_color = (
                 lambda s: "green"
                 if s.lower().startswith("g")
@@ -953,6 +425,7 @@ class FiberPhotometrySynced(dj.Imported):
             query = (FiberPhotometry.Fiber * FiberPhotometry.DemodulatedTrace) & key
 
             photometry_dict = {}
+            fibers = {}  # trace name suffix (hemisphere initial) -> fiber_id and hemisphere
 
             for row in query:
                 trace_name = (
@@ -961,6 +434,9 @@ class FiberPhotometrySynced(dj.Imported):
                 )
                 trace = row["trace"]
                 photometry_dict[trace_name] = trace
+                fibers[row["hemisphere"][0].upper()] = {
+                    "fiber_id": row["fiber_id"], "hemisphere": row["hemisphere"]
+                }
 
             photometry_df = pd.DataFrame(
                 (FiberPhotometry & key).fetch1("beh_synch_signal") | photometry_dict
@@ -981,8 +457,11 @@ class FiberPhotometrySynced(dj.Imported):
                 behavior_dir / f"{subject_id}_behavior_df_full.csv", index_col=0
             )
 
+            # resample_by_trial: align the photometry trial by trial instead of resampling
+            # the whole session at once (corrects clock drift, O(n) memory)
             aligned_behav_photo_df, time_offset = pp.resample_and_align(
-                analog_df, photometry_df, channels=trace_names
+                analog_df, photometry_df, channels=trace_names,
+                by_trial=processing_parameters.get("resample_by_trial", False),
             )
             del analog_df
 
@@ -1000,8 +479,8 @@ class FiberPhotometrySynced(dj.Imported):
 
             # Drop unnecessary columns that we don't need to save
             photo_columns = trace_names + [
-                f'z_{channel.split("_")[-1]}' for channel in trace_names[::3]
-            ]  # trace_names[::((len(trace_names)//2)+1)]]]
+                f'z_{channel.split("_")[-1]}' for channel in trace_names if "detrend" in channel
+            ]  # one z-scored trace per detrended trace
 
             cols_to_keep = [
                 "nTrial",
@@ -1020,9 +499,10 @@ class FiberPhotometrySynced(dj.Imported):
             ]
             cols_to_keep.extend(photo_columns)
 
-            timeseries_task_states_df: pd.DataFrame = deepcopy(
-                aligned_behav_photo_df[cols_to_keep]
-            )
+            # selecting the columns already copies their data, the shallow copy only
+            # detaches the selection from aligned_behav_photo_df (no chained assignment)
+            timeseries_task_states_df: pd.DataFrame = aligned_behav_photo_df[cols_to_keep].copy(deep=False)
+            del aligned_behav_photo_df
             timeseries_task_states_df["trial_clock"] = (
                 timeseries_task_states_df.groupby("nTrial").cumcount() * 5 / 1000
             )
@@ -1031,36 +511,15 @@ class FiberPhotometrySynced(dj.Imported):
             _split_penalty_states(timeseries_task_states_df, behavior_df, penalty="ENLP")
             _split_penalty_states(timeseries_task_states_df, behavior_df, penalty="CueP")
 
-            n_bins, remainder = divmod(
-                len(timeseries_task_states_df), downsample_factor
-            )  # get number of bins to downsample into
-            bin_ids = [
-                j for i in range(int(n_bins)) for j in np.repeat(i, downsample_factor)
-            ]  # define ids of bins at downsampling rate [1,1,1,1,2,2,2,2,...]
-            bin_ids.extend(
-                np.repeat(bin_ids[-1] + 1, remainder)
-            )  # tag on incomplete bin at end
-            timeseries_task_states_df[
-                "bin_ids"
-            ] = bin_ids  # new column to label new bin_ids
-
-            downsampled_states_df: pd.DataFrame = deepcopy(timeseries_task_states_df)
-
-            # Apply aggregate function to each column
-            col_fcns = {
-                col: np.max
-                for col in downsampled_states_df.columns
-                if col not in photo_columns
-            }
-            [col_fcns.update({col: np.mean}) for col in photo_columns]
-
-            # Handle penalties. Label preceding states as different from those without penalties
-            downsampled_states_df = downsampled_states_df.groupby("bin_ids").agg(col_fcns)
-            downsampled_states_df = downsampled_states_df.reset_index(drop=True)
-            downsampled_states_df = downsampled_states_df.drop(columns=["bin_ids"])
+            # Downsample to the target rate: bin maximum of the task states, bin mean of
+            # the photometry (an incomplete bin at the end takes the remaining samples)
+            downsampled_states_df: pd.DataFrame = pp.downsample_bins(
+                timeseries_task_states_df, downsample_factor, photo_columns
+            )
+            del timeseries_task_states_df
 
             # Get new
-            trace_names = list(downsampled_states_df.columns[-6:])
+            trace_names = list(photo_columns)
             # Populate FiberPhotometrySynced
             self.insert1(
                 {
@@ -1079,8 +538,7 @@ class FiberPhotometrySynced(dj.Imported):
                 synced_trace_list.append(
                     {
                         **key,
-                        "fiber_id": get_fiber_id(trace_name[-1]),
-                        "hemisphere": {"R": "right", "L": "left"}[trace_name[-1]],
+                        **fibers[trace_name[-1]],
                         "trace_name": trace_name.split("_")[0],
                         "emission_color": get_color(trace_name.split("_")[1][0]),
                         "trace": downsampled_states_df[trace_name].values,
@@ -1089,11 +547,8 @@ class FiberPhotometrySynced(dj.Imported):
 
             self.SyncedTrace.insert(synced_trace_list)
 
-        elif transform == "spectrogram":
+        elif transform in ("spectrogram", "single_bin"):
             # Parameters
-            get_fiber_id = (
-                lambda side: 1 if side.lower().startswith("r") else 2
-            )  # map hemisphere to fiber id
             get_color = (
                 lambda s: "green"
                 if s.lower().startswith("g")
@@ -1121,6 +576,7 @@ class FiberPhotometrySynced(dj.Imported):
             query = (FiberPhotometry.Fiber * FiberPhotometry.DemodulatedTrace) & key
 
             photometry_dict = {}
+            fibers = {}  # trace name suffix (hemisphere initial) -> fiber_id and hemisphere
 
             for row in query:
                 trace_name = (
@@ -1129,6 +585,9 @@ class FiberPhotometrySynced(dj.Imported):
                 )
                 trace = row["trace"]
                 photometry_dict[trace_name] = trace
+                fibers[row["hemisphere"][0].upper()] = {
+                    "fiber_id": row["fiber_id"], "hemisphere": row["hemisphere"]
+                }
 
             photometry_sync = behavior_sync_signal
             # Get trace names e.g., ["detrend_grnR", "raw_grnR"]
@@ -1150,7 +609,7 @@ class FiberPhotometrySynced(dj.Imported):
             #one more z-score over the window length
             alignedData = [] 
             if final_z == True:
-                win = round(meta_info.get("Processing_Parameters").get("z_window", 60)*behavior_sampling)
+                win = round(meta.processing_parameters.get("z_window", 60)*behavior_sampling)
                 for data in syncedData:
                     np_dsPhotom = data.iloc[1].to_numpy()[0]
                     aligned_photom = demodulation.rolling_z(np_dsPhotom, wn=win)
@@ -1186,8 +645,7 @@ class FiberPhotometrySynced(dj.Imported):
                 synced_trace_list.append(
                     {
                         **key,
-                        "fiber_id": get_fiber_id(trace_name[-1]),
-                        "hemisphere": {"R": "right", "L": "left"}[trace_name[-1]],
+                        **fibers[trace_name[-1]],
                         "trace_name": trace_name.split("_")[0],
                         "emission_color": get_color(trace_name.split("_")[1][0]),
                         #"trace": alignedData[trace_names.index(trace_name)].values
@@ -1199,6 +657,369 @@ class FiberPhotometrySynced(dj.Imported):
             self.SyncedTrace.insert(synced_trace_list)
 
 
+# primary keys of the lookup rows known to be in the database, per table
+_lookup_keys: dict = {}
+
+
+def _insert_lookups(lookup_rows: dict) -> None:
+    """Insert the lookup rows that are not in the database yet
+
+    lookup_rows maps each lookup table to the rows referenced by a session. Rows
+    already seen in the database by this process are skipped without a query,
+    the remaining ones are checked with one fetch and inserted with one bulk
+    insert per table.
+    """
+    for table, rows in lookup_rows.items():
+        primary_key = table.primary_key
+        unique_rows = {}
+        for row in rows:
+            unique_rows.setdefault(tuple(row[k] for k in primary_key), row)
+        if _lookup_keys.get(table.full_table_name, set()).issuperset(unique_rows):
+            continue
+        # refresh before inserting: rows inserted here enter the cache only once a
+        # later refresh sees them, so a rolled back make leaves no stale keys behind
+        known = {tuple(k[a] for a in primary_key) for k in table.fetch("KEY")}
+        _lookup_keys[table.full_table_name] = known
+        missing = [row for k, row in unique_rows.items() if k not in known]
+        if missing:
+            logger.info(f"{len(missing)} new entries are inserted into {__name__}.{table.__name__}")
+            table.insert(missing, skip_duplicates=True)
+
+
+def _demodulation_resources() -> tuple[int, int]:
+    """Processes and memory (bytes) available to demodulate a session"""
+    # number of processes used to demodulate channels in parallel
+    n_workers = int(dj.config["custom"].get("demodulation.n_workers", 1))
+    # traces are demodulated block by block when they would not fit this budget
+    memory_budget_gb = dj.config["custom"].get("demodulation.memory_budget_gb", 0)
+    memory_budget = (memory_budget_gb * 1024**3 if memory_budget_gb
+                     else demodulation.default_memory_budget())
+    return n_workers, memory_budget
+
+
+def _demodulated_trace_rows(key, meta, demodulated: dict) -> list[dict]:
+    """Trace rows of the demodulated {(side, color): (trace, carrier frequency)}
+
+    One demodulated trace per row of the channel table, photometry and carrier
+    channels of a fiber and color share the trace
+    """
+    rows = []
+    for channel in meta.channels:
+        if (channel.side, channel.color) not in demodulated:
+            continue
+        demod_trace, carrier_frequency = demodulated[(channel.side, channel.color)]
+        color_info = meta.fibers[channel.side].colors[channel.color]
+        rows.append(
+            {
+                **key,
+                "fiber_id": channel.fiber_id,
+                "hemisphere": channel.side,
+                "trace_name": channel.role,
+                "emission_color": COLOR_MAPPING[channel.color],
+                "sensor_protein_name": color_info.sensor_protein,
+                "excitation_wavelength": color_info.excitation_wavelength,
+                "carrier_frequency": carrier_frequency,
+                "demod_sample_rate": carrier_frequency,
+                "trace": demod_trace,
+            }
+        )
+    return rows
+
+
+def _read_mat_channels(mat_file: Path, channels, n_samples=None) -> dict:
+    """Channels of the ``data`` matrix of a MATLAB file, through the raw cache if enabled
+
+    Reads of the leading n_samples only go to the file, they are not cached
+    """
+    if n_samples is not None:
+        return photometry_io.read_mat_channels(mat_file, "data", channels, n_samples=n_samples)
+    return raw_cache.cached_channels(
+        [mat_file], "data", channels,
+        lambda missing: photometry_io.read_mat_channels(mat_file, "data", missing),
+    )
+
+
+def _read_tdt_channels(photometry_dir: Path, store_channels: dict, t2=0) -> dict:
+    """Channels of TDT stream stores, through the raw cache if enabled
+
+    Reads of the first t2 seconds only go to the block, they are not cached
+    """
+    if t2:
+        return photometry_io.read_tdt_channels(photometry_dir, store_channels, t2=t2)
+    block_files = [f for f in photometry_dir.glob("*.t*") if f.suffix != ".toml"]
+    return {
+        store: raw_cache.cached_channels(
+            block_files, store, channels,
+            lambda missing, store=store: photometry_io.read_tdt_channels(
+                photometry_dir, {store: missing})[store],
+        )
+        for store, channels in store_channels.items()
+    }
+
+
+def _photometry_data_format(photometry_dir: Path) -> str:
+    """Data format of a Photometry folder
+
+    data*.mat: raw MATLAB data, *timeseries*.mat: demodulated (demux) MATLAB data
+    (v7.3 files are read lazily), other *.t* files: a TDT block
+    """
+    if any(photometry_dir.glob("data*.mat")):
+        return "matlab_data"
+    photometry_file = next(photometry_dir.glob("*timeseries*.mat"), None)
+    if photometry_file is not None:
+        if photometry_io.mat_file_version(photometry_file) < 2:
+            return "demux_matlab_data"
+        return "demux_matlab_data_mat73"
+    if any(f.suffix != ".toml" for f in photometry_dir.glob("*.t*")):
+        return "tdt_data"
+    raise FileNotFoundError(f"No photometry data found in {photometry_dir}")
+
+
+def _read_raw_matlab(photometry_dir: Path, meta) -> tuple[dict, object]:
+    """Raw channels of a data*.mat file, all fibers share the ``data`` matrix"""
+    mat_file = next(photometry_dir.glob("data*.mat"))
+    sources = {side: "data" for side in meta.fibers}
+    if not photometry_io.mat_channels_seekable(mat_file, "data"):
+        # compressed files are loaded whole on every read, read the used channels once
+        traces = _read_mat_channels(mat_file, meta.channel_indices)
+        return sources, lambda channel_keys, n_samples=None: {
+            (s, i): traces[i][:n_samples] for s, i in channel_keys
+        }
+
+    def read(channel_keys, n_samples=None):
+        traces = _read_mat_channels(mat_file, [index for _, index in channel_keys], n_samples)
+        return {(source, index): traces[index] for source, index in channel_keys}
+
+    return sources, read
+
+
+def _read_raw_tdt(photometry_dir: Path, meta) -> tuple[dict, object]:
+    """Raw channels of a TDT block, fiber n is recorded in the Fi<n>r store"""
+    sources = {side: f"Fi{fiber.fiber_id}r" for side, fiber in meta.fibers.items()}
+
+    def read(channel_keys, n_samples=None):
+        store_channels = {}
+        for store, index in channel_keys:
+            store_channels.setdefault(store, []).append(index)
+        # TDT reads time ranges, twice the nominal duration covers n_samples
+        t2 = 2 * n_samples / meta.sampling_frequency if n_samples else 0
+        streams = _read_tdt_channels(photometry_dir, store_channels, t2=t2)
+        return {(store, index): streams[store][index][:n_samples] for store, index in channel_keys}
+
+    return sources, read
+
+
+def _read_demux_matlab(photometry_dir: Path, meta) -> tuple[dict, object]:
+    """Demodulated traces and carrier frequencies of a *timeseries*.mat file"""
+    photometry_file = next(photometry_dir.glob("*timeseries*.mat"))
+    time_series: list[dict] = spio.loadmat(
+        photometry_file, simplify_cells=True, variable_names=["timeSeries"]
+    )["timeSeries"]
+    demodulated = {
+        (side, letter): (
+            time_series[color.photom_index]["data"],
+            time_series[color.carrier_index]["demux_freq"] if color.carrier_index is not None else None,
+        )
+        for side, fiber in meta.fibers.items()
+        for letter, color in fiber.colors.items()
+        if color.photom_index is not None
+    }
+    return demodulated, time_series[0]["time_offset"]
+
+
+def _read_demux_matlab_mat73(photometry_dir: Path, meta) -> tuple[dict, object]:
+    """Demodulated traces and carrier frequencies of a MATLAB v7.3 *timeseries*.mat file,
+    only the used struct elements are read"""
+    photometry_file = next(photometry_dir.glob("*timeseries*.mat"))
+    time_series = photometry_io.read_mat73_struct(
+        photometry_file, "timeSeries", ["data", "time_offset", "demux_freq"],
+        sorted({0, *meta.channel_indices}),
+    )
+    demodulated = {
+        (side, letter): (
+            time_series["data"][color.photom_index],
+            time_series["demux_freq"].get(color.carrier_index),
+        )
+        for side, fiber in meta.fibers.items()
+        for letter, color in fiber.colors.items()
+        if color.photom_index is not None
+    }
+    return demodulated, time_series["time_offset"][0]
+
+
+# Readers of the raw (modulated) data formats, channels are read on demand:
+#   reader(photometry_dir, meta) -> ({side: source}, read)
+#   read([(source, channel index), ...], n_samples=None) -> {(source, channel index): trace}
+#   (only the leading n_samples of each trace when given)
+_RAW_READERS = {"matlab_data": _read_raw_matlab, "tdt_data": _read_raw_tdt}
+# Readers of the demodulated data formats:
+#   reader(photometry_dir, meta) -> ({(side, color): (trace, carrier frequency)}, beh_synch_signal)
+_DEMUX_READERS = {
+    "demux_matlab_data": _read_demux_matlab,
+    "demux_matlab_data_mat73": _read_demux_matlab_mat73,
+}
+# the carrier frequencies of the right fiber are set under Processing_Parameters.left
+# in the TOML files and vice versa
+_SET_CARRIER_SIDE = {"right": "left", "left": "right"}
+# leading samples of a carrier channel its frequency is detected from
+_CARRIER_POINTS = 2**14
+
+
+def _plan_raw_channels(meta, sources, read) -> list[dict]:
+
+    """
+    Pair the photometry and carrier channels of the channel table and detect the carriers
+    INPUTS:
+        meta: MetaInfo of the session
+        sources: {side: source (matrix or store) the fiber's channels are read from}
+        read: channel reader of the data format
+    OUTPUTS:
+        one dict per (side, color) to demodulate with its photometry and carrier
+        channel keys and the detected carrier frequency
+    Only the leading samples of the carrier channels are read, all carriers are
+    detected in one batch
+    """
+
+    processing_parameters = meta.processing_parameters
+    plan = []
+    for side, fiber in meta.fibers.items():
+        for letter, color in fiber.colors.items():
+            if color.photom_index is None:
+                continue
+            if color.carrier_index is None:
+                logger.warning(f"No carrier channel for the {letter} trace of the {side} fiber, skipped")
+                continue
+            plan.append(
+                {
+                    "pair": (side, letter),
+                    "photom": (sources[side], color.photom_index),
+                    "carrier": (sources[side], color.carrier_index),
+                }
+            )
+
+    carrier_keys = sorted({entry["carrier"] for entry in plan})
+    snippets = read(carrier_keys, n_samples=_CARRIER_POINTS)
+    carriers = dict(zip(carrier_keys, demodulation.calc_carry(
+        [snippets[carrier_key] for carrier_key in carrier_keys], meta.sampling_frequency,
+        points_2_process=_CARRIER_POINTS,
+    )))
+    del snippets
+
+    for entry in plan:
+        side, letter = entry["pair"]
+        entry["carrier_frequency"] = carrier = carriers[entry["carrier"]]
+        set_carrier = (processing_parameters.get(_SET_CARRIER_SIDE.get(side, side), {})
+                       .get(f"carrier_frequency_{letter}", 0))
+        if set_carrier and abs(set_carrier - carrier) >= 5:
+            warnings.warn("Calculated carrier frequency does not match set carrier frequency. Using calculated carrier frequency.")
+    return plan
+
+
+def _demodulate_raw_batches(meta, plan, read, variants=None, n_workers=1, memory_budget=None):
+
+    """
+    Demodulate the planned traces photodetector by photodetector
+    INPUTS:
+        meta: MetaInfo of the session
+        plan: output of _plan_raw_channels
+        read: channel reader of the data format
+        variants: Processing_Parameters to demodulate with (default: the session's own),
+                  every variant is computed from the same read of a batch
+        n_workers, memory_budget: see demodulation.process_trace, used with a single variant
+    YIELDS (per batch of photodetectors):
+        one {(side, color): (demodulated trace, carrier frequency)} per variant
+    A batch holds as many photodetectors (raw channels) as there are workers, so
+    peak memory scales with the raw channels demodulated in parallel, not with
+    all channels of the session. Traces read from the same channel share a
+    photodetector and are demodulated together.
+    """
+
+    sampling_Hz = meta.sampling_frequency
+    if variants is None:
+        variants = [meta.processing_parameters]
+    demod_variants = [
+        {
+            "window1": round(params.get("z_window", 60) * sampling_Hz),
+            "num_perseg": params.get("no_per_segment", 216),
+            "n_overlap": params.get("noverlap", 108),
+            "method": "single_bin" if params.get("transform") == "single_bin" else "spectrogram",
+        }
+        for params in variants
+    ]
+
+    detectors = list(dict.fromkeys(entry["photom"] for entry in plan))
+    batch_size = max(1, n_workers)
+    for start in range(0, len(detectors), batch_size):
+        batch_detectors = detectors[start : start + batch_size]
+        batch = [entry for entry in plan if entry["photom"] in batch_detectors]
+
+        # Load the batch's raw channels as one 2-D array (rows)
+        raw_channels = read(batch_detectors)
+        lengths = {len(raw_channels[detector]) for detector in batch_detectors}
+        nbytes = sum(np.asarray(raw_channels[d]).nbytes for d in batch_detectors)
+        if len(lengths) == 1 and (memory_budget is None or nbytes <= memory_budget / 2):
+            raw = np.stack([np.asarray(raw_channels[detector]) for detector in batch_detectors])
+        else:
+            # too large to copy at once (or of unequal lengths): keep the (memory-mapped) rows
+            raw = [raw_channels[detector] for detector in batch_detectors]
+        del raw_channels
+        row_of = {detector: row for row, detector in enumerate(batch_detectors)}
+
+        raw_photom_list = [raw[row_of[entry["photom"]]] for entry in batch]
+        calc_carry_list = [entry["carrier_frequency"] for entry in batch]
+        detector_groups = [row_of[entry["photom"]] for entry in batch]
+        if len(demod_variants) == 1:
+            variant = demod_variants[0]
+            _, _, _, spect_power_list = demodulation.process_trace(
+                raw_photom_list, calc_carry_list, sampling_Hz, variant["window1"],
+                variant["num_perseg"], variant["n_overlap"], method=variant["method"],
+                groups=detector_groups, n_workers=n_workers, memory_budget=memory_budget,
+            )
+            spect_power_lists = [spect_power_list]
+        else:
+            spect_power_lists = demodulation.process_trace_variants(
+                raw_photom_list, calc_carry_list, sampling_Hz, demod_variants,
+                groups=detector_groups,
+            )
+
+        demodulated_variants = [
+            {
+                entry["pair"]: (spect_power, entry["carrier_frequency"])
+                for entry, spect_power in zip(batch, spect_power_list)
+            }
+            for spect_power_list in spect_power_lists
+        ]
+        # release the batch's raw rows before yielding, the next batch is read on resume
+        del raw, raw_photom_list, spect_power_lists
+        yield demodulated_variants
+
+
+def _load_raw_photometry(key) -> tuple[dict, float]:
+    """Raw photometry traces of a session keyed by (hemisphere, emission color)
+
+    Demodulated (``*timeseries*.mat``) sessions have no raw traces.
+    """
+    session_dir = (session.SessionDirectory & key).fetch1("session_dir")
+    session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
+    photometry_dir = session_full_dir / "Photometry"
+
+    meta = load_meta_info(photometry_dir)
+    data_format = _photometry_data_format(photometry_dir)
+    if data_format not in _RAW_READERS:
+        return {}, meta.sampling_frequency
+    sources, read = _RAW_READERS[data_format](photometry_dir, meta)
+
+    photom_channels = [channel for channel in meta.channels if channel.role == "photom"]
+    raw_channels = read(sorted({(sources[c.side], c.index) for c in photom_channels}))
+    traces = {
+        (channel.side, COLOR_MAPPING[channel.color]): np.asarray(
+            raw_channels[(sources[channel.side], channel.index)]
+        )
+        for channel in photom_channels
+    }
+    return traces, meta.sampling_frequency
+
+
 def _split_penalty_states(
     df: pd.DataFrame, behavior_df: pd.DataFrame, penalty: str = "ENLP"
     ) -> None:
@@ -0,0 +1,137 @@
+import datajoint as dj
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+from element_interface.utils import find_full_path
+from workflow import db_prefix
+from workflow.pipeline import session, photometry
+from workflow.utils.paths import get_raw_root_data_dir
+import workflow.utils.photometry_preprocessing as pp
+from workflow.utils import clock_map
+from workflow.utils.meta_info import load_meta_info
+
+
+logger = dj.logger
+schema = dj.schema(db_prefix + "sync")
+
+
+@schema
+class SessionClockMap(dj.Computed):
+    definition = """ # maps the samples of every recording stream of a session to the session clock
+    -> session.Session
+    """
+
+    class Stream(dj.Part):
+        definition = """ # piecewise-linear map from the samples of a recording stream to the session clock
+        -> master
+        stream_name     : varchar(32)  # (e.g., behavior, photometry)
+        ---
+        n_samples       : int unsigned
+        sample_rate     : float     # mean sampling rate over the mapped samples (in Hz)
+        sample_index    : longblob  # anchor sample indices, increasing
+        session_clock   : longblob  # session clock at the anchors (in second)
+        """
+
+    key_source = session.Session & photometry.FiberPhotometry
+
+    @classmethod
+    def to_session_clock(cls, key, stream_name: str, indices) -> np.ndarray:
+        """Session clock (in second) of sample indices of a stream, e.g.
+        SessionClockMap.to_session_clock(session_key, "photometry", np.arange(n))"""
+        sample_index, session_clock = (
+            cls.Stream & key & {"stream_name": stream_name}
+        ).fetch1("sample_index", "session_clock")
+        return clock_map.to_session_clock(indices, sample_index, session_clock)
+
+    @classmethod
+    def to_sample_index(cls, key, stream_name: str, times) -> np.ndarray:
+        """Fractional sample indices of a stream at session clock times (in second)"""
+        sample_index, session_clock = (
+            cls.Stream & key & {"stream_name": stream_name}
+        ).fetch1("sample_index", "session_clock")
+        return clock_map.to_sample_index(times, sample_index, session_clock)
+
+    def make(self, key):
+
+        subject_id, session_dir = (session.SessionDirectory & key).fetch1(
+            "subject", "session_dir"
+        )
+        session_full_dir: Path = find_full_path(get_raw_root_data_dir(), session_dir)
+        behavior_dir = session_full_dir / "Behavior"
+        meta = load_meta_info(behavior_dir, require_signals=False)
+        processing_parameters = meta.processing_parameters
+        transform = processing_parameters.get("transform")
+        behavior_sample_rate = processing_parameters.get("behavior_sampling", 200)
+
+        streams = {}
+
+        # Behavior: rows of the 200 Hz state transition data, the session clock
+        # (required by hilbert sessions, their photometry is aligned through it)
+        analog_file = behavior_dir / f"{subject_id}_analog_filled.csv"
+        if analog_file.exists() or transform == "hilbert":
+            analog_df = pd.read_csv(analog_file, index_col=0)
+            streams["behavior"] = clock_map.compress_clock(
+                np.arange(len(analog_df)),
+                analog_df.index.to_numpy() / behavior_sample_rate,
+                tolerance=1e-9,
+            ) + (len(analog_df),)
+
+        # Photometry: samples of the demodulated traces (FiberPhotometry.DemodulatedTrace)
+        if transform == "hilbert":
+            beh_synch_signal = (photometry.FiberPhotometry & key).fetch1("beh_synch_signal")
+            photo_df = pd.DataFrame(
+                {name: beh_synch_signal[name] for name in ("toBehSys", "fromBehSys")}
+            )
+            # anchor every trial start matched between the systems, as FiberPhotometrySynced aligns them
+            start = pp.handshake_start(photo_df)
+            photo_starts, behavior_starts = pp.align_trial_starts(
+                analog_df, photo_df.loc[start:].reset_index(drop=True)
+            )
+            # trial starts are only known to one behavior sample
+            streams["photometry"] = clock_map.compress_clock(
+                start + photo_starts,
+                clock_map.to_session_clock(behavior_starts, *streams["behavior"][:2]),
+                tolerance=0.5 / behavior_sample_rate,
+            ) + (len(photo_df),)
+        elif transform in ("spectrogram", "single_bin"):
+            # the session starts at the behavior_offset sample, as FiberPhotometrySynced trims the traces
+            behavior_offset = processing_parameters.get("behavior_offset", 0)
+            n_samples = len(
+                (photometry.FiberPhotometry.DemodulatedTrace & key).fetch("trace", limit=1)[0]
+            )
+            photometry_dir = session_full_dir / "Photometry"
+            if photometry._photometry_data_format(photometry_dir) in photometry._RAW_READERS:
+                # demodulated by FiberPhotometry: one sample per spectrogram segment of the raw data
+                photometry_parameters = load_meta_info(
+                    photometry_dir, require_signals=False
+                ).processing_parameters
+                sample_index, session_clock = clock_map.segment_clock(
+                    photometry_parameters.get("no_per_segment", 216),
+                    photometry_parameters.get("noverlap", 108),
+                    (photometry.FiberPhotometry & key).fetch1("raw_sample_rate"),
+                    first_segment=behavior_offset,
+                )
+            else:
+                # demodulated traces of the acquisition are at the behavior sampling rate
+                sample_index = np.array([behavior_offset, behavior_offset + 1])
+                session_clock = np.array([0, 1 / behavior_sample_rate])
+            streams["photometry"] = (sample_index, session_clock, n_samples)
+        else:
+            logger.warning(f"No photometry clock map for transform {transform} of {key}")
+
+        self.insert1(key)
+        self.Stream.insert(
+            [
+                {
+                    **key,
+                    "stream_name": stream_name,
+                    "n_samples": n_samples,
+                    "sample_rate": (sample_index[-1] - sample_index[0])
+                    / (session_clock[-1] - session_clock[0]),
+                    "sample_index": sample_index,
+                    "session_clock": session_clock,
+                }
+                for stream_name, (sample_index, session_clock, n_samples) in streams.items()
+            ]
+        )
@@ -1,4 +1,6 @@
 import sys
+import argparse
+import datajoint as dj
 from datajoint_utilities.dj_worker import parse_args
 
 from workflow.populate.worker import (standard_worker, spike_sorting_worker,
@@ -20,6 +22,8 @@ def run(**kwargs):
         worker._run_duration = kwargs["duration"]
     if kwargs.get("sleep") is not None:
         worker._sleep_duration = kwargs["sleep"]
+    if kwargs.get("n_workers") is not None:
+        dj.config["custom"]["demodulation.n_workers"] = kwargs["n_workers"]
 
     try:
         worker.run()
@@ -35,11 +39,17 @@ def cli():
 
     This function can be used as entry point to create console scripts with setuptools.
     """
-    args = parse_args(sys.argv[1:])
+    # pool size for parallel photometry demodulation, not known to the shared parser
+    pool_parser = argparse.ArgumentParser(add_help=False)
+    pool_parser.add_argument("--n-workers", dest="n_workers", type=int, default=None)
+    pool_args, argv = pool_parser.parse_known_args(sys.argv[1:])
+
+    args = parse_args(argv)
     run(
         worker_name=args.worker_name,
         duration=args.duration,
-        sleep=args.sleep
+        sleep=args.sleep,
+        n_workers=pool_args.n_workers,
     )
 
 
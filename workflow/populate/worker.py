@@ -6,6 +6,7 @@ from workflow.pipeline import (
     ephys,
     scan,
     photometry,
+    sync,
     imaging,
     model as dlc_model,
     ingestion,
@@ -85,7 +86,9 @@ standard_worker(ephys.LFP, max_calls=5)
 
 # photometry
 standard_worker(photometry.FiberPhotometry, max_calls=5)
+standard_worker(photometry.Demodulation, max_calls=5)
 standard_worker(photometry.FiberPhotometrySynced, max_calls=5)
+standard_worker(sync.SessionClockMap, max_calls=5)
 
 # spike_sorting process for GPU required jobs
 spike_sorting_worker = DataJointWorker(
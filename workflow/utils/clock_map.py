@@ -0,0 +1,111 @@
+"""
+Piecewise-linear maps from the sample indices of a recording stream to the session clock
+
+A map is a pair of increasing anchor arrays (sample_index, session_clock); samples
+between anchors are interpolated linearly and samples outside them extrapolated
+along the first/last segment. Converting n samples takes O(n log m) for m anchors.
+"""
+
+from __future__ import annotations
+import numpy as np
+
+
+def _segments(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) < 2 or len(x) != len(y):
+        raise ValueError("A clock map needs at least two (sample_index, session_clock) anchors")
+    if np.any(np.diff(x) <= 0) or np.any(np.diff(y) <= 0):
+        raise ValueError("Clock map anchors must be strictly increasing")
+    return x, y
+
+
+def _interp(values, x, y):
+    # linear interpolation with linear extrapolation along the end segments
+    values = np.asarray(values, dtype=float)
+    segment = np.clip(np.searchsorted(x, values, side="right") - 1, 0, len(x) - 2)
+    slope = (y[segment + 1] - y[segment]) / (x[segment + 1] - x[segment])
+    return y[segment] + (values - x[segment]) * slope
+
+
+def to_session_clock(indices, sample_index, session_clock) -> np.ndarray:
+
+    """
+    Session clock of samples of a stream
+    INPUTS:
+        indices: sample indices (scalar or array, may be fractional)
+        sample_index, session_clock: anchors of the stream's clock map
+    OUTPUTS:
+        session clock of the samples (in second)
+    """
+
+    return _interp(indices, *_segments(sample_index, session_clock))
+
+
+def to_sample_index(times, sample_index, session_clock) -> np.ndarray:
+
+    """
+    Fractional sample indices of a stream at session clock times (inverse of to_session_clock)
+    INPUTS:
+        times: session clock times (in second)
+        sample_index, session_clock: anchors of the stream's clock map
+    OUTPUTS:
+        sample indices of the stream, round them to get the nearest samples
+    """
+
+    x, y = _segments(sample_index, session_clock)
+    return _interp(times, y, x)
+
+
+def segment_clock(nperseg: int, noverlap: int, fs: float, first_segment: float = 0) -> tuple[np.ndarray, np.ndarray]:
+
+    """
+    Clock map of a stream of spectrogram segments, e.g. traces demodulated with a spectrogram
+    INPUTS:
+        nperseg, noverlap: segment length and overlap (in samples of the transformed signal)
+        fs: sampling rate of the transformed signal (in Hz)
+        first_segment: segment whose window starts at session clock 0
+    OUTPUTS:
+        sample_index, session_clock anchors of the segments
+    Segments are nperseg - noverlap samples apart and each is timed at the centre of
+    its window, nperseg / 2 samples after the window start (as scipy.signal.spectrogram).
+    """
+
+    step = nperseg - noverlap
+    if step <= 0:
+        raise ValueError(f"noverlap ({noverlap}) must be smaller than nperseg ({nperseg})")
+    sample_index = np.array([0.0, 1.0])
+    return sample_index, ((sample_index - first_segment) * step + nperseg / 2) / fs
+
+
+def compress_clock(sample_index, session_clock, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+
+    """
+    Reduce a clock map to the anchors needed to reproduce it within a tolerance
+    INPUTS:
+        sample_index, session_clock: anchors, e.g. every sample of a stream and its timestamp
+        tolerance: largest clock error allowed between anchors (in second), should exceed
+                   the jitter of the timestamps
+    OUTPUTS:
+        sample_index, session_clock of the kept anchors (the first and last are always kept)
+    Anchors are dropped with the Douglas-Peucker algorithm: a segment is split at its
+    worst fitting anchor until every dropped anchor is within tolerance of its segment.
+    """
+
+    x, y = _segments(sample_index, session_clock)
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = slice(first + 1, last)
+        fit = y[first] + (x[inner] - x[first]) * (y[last] - y[first]) / (x[last] - x[first])
+        error = np.abs(y[inner] - fit)
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.extend([(first, split), (split, last)])
+    return x[keep], y[keep]
@@ -20,6 +20,16 @@ from scipy import interpolate
 from scipy import optimize
 from scipy.signal.windows import hamming
 from copy import deepcopy
+import fractions
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from workflow.utils.rolling import rolling_zscore
+from workflow.utils import stage_cache
 
 
 def gen_sine(x, timepoints=None):
@@ -47,27 +57,125 @@ def is_filter_stable(coeffs):
     return np.all(np.abs(p) <= 1.0)
 
 
+# maximum number of designs kept by each of the caches below
+FILTER_CACHE_SIZE = 256
+RESAMPLE_FIR_CACHE_SIZE = 16
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def _cached_sos(family, order, cutoff, btype, fs, ripple, attenuation):
+    # design and check an sos filter once per parameter set
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        if family == "ellip":
+            sos = signal.ellip(
+                order, ripple, attenuation, list(cutoff) if isinstance(cutoff, tuple) else cutoff,
+                btype=btype, fs=fs, output="sos",
+            )
+        elif family == "butter":
+            sos = signal.butter(
+                order, list(cutoff) if isinstance(cutoff, tuple) else cutoff,
+                btype=btype, fs=fs, output="sos",
+            )
+        else:
+            raise ValueError("Did not understand filter family {}".format(family))
+    return sos, bool(is_filter_stable(sos))
+
+
+def design_sos(family, order, cutoff, btype, fs, ripple=None, attenuation=None):
+
+    """
+    Cached sos filter design, keyed by the design parameters
+    INPUTS:
+        family: "ellip" or "butter"
+        cutoff: cutoff frequency, or (low, high) for band filters
+    OUTPUTS:
+        sos: a copy of the cached coefficients (scipy needs writable arrays)
+        stable: whether all poles lie in the unit circle
+    """
+
+    if np.ndim(cutoff) > 0:
+        cutoff = tuple(float(c) for c in cutoff)
+    else:
+        cutoff = float(cutoff)
+    sos, stable = _cached_sos(
+        family, int(order), cutoff, btype, float(fs),
+        None if ripple is None else float(ripple),
+        None if attenuation is None else float(attenuation),
+    )
+    return sos.copy(), stable
+
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def resample_ratio(fs, new_fs):
+    # polyphase up/down factors for resampling fs to new_fs
+    frac = fractions.Fraction(new_fs / fs).limit_denominator()
+    return frac.numerator, frac.denominator
+
+
+@functools.lru_cache(maxsize=RESAMPLE_FIR_CACHE_SIZE)
+def _resample_fir(up, down):
+    # anti-aliasing FIR that signal.resample_poly designs by default
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+
+
+def filter_cache_info():
+
+    """
+    Hit/miss counters of the filter design and resampling plan caches
+    """
+
+    return {
+        "sos": _cached_sos.cache_info(),
+        "resample_ratio": resample_ratio.cache_info(),
+        "resample_fir": _resample_fir.cache_info(),
+    }
+
+
+def clear_filter_cache():
+    _cached_sos.cache_clear()
+    resample_ratio.cache_clear()
+    _resample_fir.cache_clear()
+
+
 def bandpass_signal(
     x, center_fs, fs=6103.515625, order=4, bw=50, attenuation=40, ripple=0.1
 ):
 
-    sos = signal.ellip(
+    # filters along the last axis; center_fs may give one value per row of a 2-D x
+    if np.ndim(center_fs) > 0:
+        x = np.asarray(x)
+        cleaned_signal = np.empty(x.shape, dtype=np.result_type(x.dtype, np.float32))
+        center_fs = np.asarray(center_fs)
+        for center in np.unique(center_fs):
+            rows = center_fs == center
+            cleaned_signal[rows] = bandpass_signal(
+                x[rows], center, fs=fs, order=order, bw=bw,
+                attenuation=attenuation, ripple=ripple,
+            )
+        return cleaned_signal
+
+    sos, stable = design_sos(
+        "ellip",
         order,
-        ripple,
-        attenuation,
-        [center_fs - (bw // 2), center_fs + (bw // 2)],
-        btype="bandpass",
-        fs=fs,
-        output="sos",
+        (center_fs - (bw // 2), center_fs + (bw // 2)),
+        "bandpass",
+        fs,
+        ripple=ripple,
+        attenuation=attenuation,
     )
 
-    if not is_filter_stable(sos):
+    if not stable:
         raise ValueError(
             "Bandpass filter is unstable, change your design specifications"
         )
 
-    cleaned_signal = deepcopy(x)
-    cleaned_signal = signal.sosfiltfilt(sos, cleaned_signal)
+    x = np.asarray(x)
+    if x.dtype == np.float32:
+        sos = sos.astype(np.float32)
+    cleaned_signal = signal.sosfiltfilt(sos, x, axis=-1)
     return cleaned_signal
 
 
@@ -82,18 +190,18 @@ def get_baseline(x, win_samples, percentile=10):
 
 def downsample(x, fs, new_fs, method="polyphase"):
 
+    # resamples along the last axis
     x[np.isnan(x)] = 0
 
     if method.lower()[0] == "f":
-        total_secs = len(x) / fs
+        total_secs = x.shape[-1] / fs
         new_total = int(new_fs * total_secs)
-        new_signal = signal.resample(x, new_total)
+        new_signal = signal.resample(x, new_total, axis=-1)
     elif method.lower()[0] == "p":
-        import fractions
-
-        frac = fractions.Fraction(new_fs / fs).limit_denominator()
-        p, q = frac.numerator, frac.denominator
-        new_signal = signal.resample_poly(x, p, q)
+        p, q = resample_ratio(float(fs), float(new_fs))
+        # cached taps in the working dtype, float64 taps would upcast float32 signals
+        window = _resample_fir(p, q).astype(np.result_type(x.dtype, np.float32), copy=False)
+        new_signal = signal.resample_poly(x, p, q, axis=-1, window=window)
     else:
         raise ValueError("Did not understand downsample method {}".format(method))
 
@@ -158,8 +266,118 @@ def detect_fs(x, tstep):
     return np.abs(hz[mx_fs])
 
 
+def fft_peak_frequency(x, tstep, pad_factor=4):
+
+    """
+    Frequency of the largest spectral peak of x, interpolated between FFT bins
+    INPUTS:
+        x: input sine wave snippet
+        tstep: time step between samples of x
+        pad_factor: zero-pad the FFT by this factor for a finer frequency grid
+    OUTPUTS:
+        peak frequency (Hz), from a parabola through the log magnitudes of the
+        Hann windowed, zero-padded spectrum around its maximum (DC excluded)
+    """
+
+    x = np.asarray(x, dtype="float")
+    n_fft = int(pad_factor * 2 ** int(np.ceil(np.log2(max(len(x), 2)))))
+    spectrum = np.abs(np.fft.rfft((x - np.mean(x)) * np.hanning(len(x)), n=n_fft))
+    k = int(np.argmax(spectrum[1:])) + 1
+    shift = 0.0
+    if k < len(spectrum) - 1:
+        a, b, c = np.log(spectrum[k - 1 : k + 2] + np.finfo(float).tiny)
+        denom = a - 2 * b + c
+        if denom < 0:
+            shift = 0.5 * (a - c) / denom
+    return (k + shift) / (n_fft * tstep)
+
+
+def _fit_sine_lstsq(x, timestamps, freq, seed_fs=None, n_iter=5, max_rejected=10):
+
+    """
+    Least squares fit of [amplitude, frequency, phase, offset] for a sine wave
+    Amplitude, phase and offset are solved in closed form on sin/cos regressors at
+    freq (and at seed_fs, e.g. the FFT peak, if that fits better), then refined
+    together with frequency by up to n_iter Levenberg-Marquardt steps
+    OUTPUTS:
+        params: fitted [amplitude, frequency, phase, offset]
+        improved: whether the fit has a lower SSE than the closed form fit at freq
+    """
+
+    # work in centred time so the phase and frequency columns are well conditioned
+    t_mid = np.mean(timestamps)
+    t = timestamps - t_mid
+
+    def linear_fit(f):
+        theta = 2 * np.pi * f * t
+        design = np.column_stack([np.sin(theta), np.cos(theta), np.ones_like(t)])
+        (a, b, offset), *_ = np.linalg.lstsq(design, x, rcond=None)
+        params = np.array([np.hypot(a, b), f, np.arctan2(b, a), offset])
+        residuals = x - gen_sine(params, t)
+        return params, residuals, np.sum(residuals**2)
+
+    params, residuals, sse = linear_fit(freq)
+    initial_sse = sse
+    if seed_fs is not None and np.isfinite(seed_fs) and seed_fs != freq:
+        seeded = linear_fit(seed_fs)
+        if seeded[2] < sse:
+            params, residuals, sse = seeded
+
+    # Levenberg-Marquardt: Gauss-Newton steps, damped until they lower the SSE
+    damping, accepted, rejected = 1e-3, 0, 0
+    while accepted < n_iter and rejected < max_rejected:
+        theta = 2 * np.pi * params[1] * t + params[2]
+        cos_theta = params[0] * np.cos(theta)
+        jacobian = np.column_stack(
+            [np.sin(theta), 2 * np.pi * t * cos_theta, cos_theta, np.ones_like(t)]
+        )
+        jtj = jacobian.T @ jacobian
+        try:
+            step = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj)), jacobian.T @ residuals)
+        except np.linalg.LinAlgError:
+            break
+        new_params = params + step
+        new_residuals = x - gen_sine(new_params, t)
+        new_sse = np.sum(new_residuals**2)
+        if not new_sse < sse:
+            damping *= 10
+            rejected += 1
+            continue
+        converged = np.abs(step[1]) < 1e-9 * max(1.0, np.abs(params[1]))
+        params, residuals, sse = new_params, new_residuals, new_sse
+        damping = max(damping / 10, 1e-12)
+        accepted += 1
+        rejected = 0
+        if converged:
+            break
+
+    # back to the original time base
+    params[2] = np.angle(np.exp(1j * (params[2] - 2 * np.pi * params[1] * t_mid)))
+    return params, bool(sse < initial_sse)
+
+
+def _fit_sine_fmin(ref, timestamps, expected_fs):
+    # Nelder-Mead fit of [amplitude, frequency, phase, offset] by minimizing the SSE
+
+    # initialize best guesses of new params
+    init_vec = [np.nanstd(ref), expected_fs, 0, np.nanmean(ref)]
+
+    # calculate phase offset from input and reference signals and fill into init_vec
+    init_fit_angle = np.angle(
+        signal.hilbert(stats.zscore(gen_sine(init_vec, timestamps)))
+    )
+    data_angle = np.angle(signal.hilbert(ref.astype("float")))
+    phase_diff = -np.angle(np.mean(np.exp(1j * (init_fit_angle - data_angle))))
+    init_vec[2] = phase_diff
+
+    # fit params to bp filtered signal by minimizing SSE
+    obj_fun = lambda p: np.sum(get_residuals(p, signal=ref, timepoints=timestamps) ** 2)
+    return optimize.fmin(obj_fun, init_vec, disp=False)
+
+
 def fit_reference(
-    x, timestamps, expected_fs=None, mod_bandpass=True, bandpass_kwargs={}
+    x, timestamps, expected_fs=None, mod_bandpass=True, bandpass_kwargs={},
+    method="lstsq", n_iter=5,
 ):
 
     """
@@ -168,12 +386,21 @@ def fit_reference(
         x: snippet of freq modulated signal measured with photodiode
         timestamps: corresponding snippet of time points for x
         expected_fs: detected carrier freq
+        method: "lstsq" solves amplitude, phase and offset by linear least squares,
+                starting from expected_fs or the interpolated FFT peak of the
+                bandpassed snippet, and refines frequency with up to n_iter
+                Levenberg-Marquardt steps (falls back to "fmin" if these don't
+                improve on the fit at expected_fs),
+                "fmin" minimizes the SSE with Nelder-Mead (previous default)
     OUTPUTS:
         new_params: [amplitude, frequency, phase, offset] for sine wave
         sine wave snippet created with new_params
         ref: bandpass filtered reference wave for snippet
     """
 
+    if method not in ("lstsq", "fmin"):
+        raise ValueError("Did not understand reference fit method {}".format(method))
+
     tstep = np.nanmean(np.diff(timestamps))  # length of each timestep
 
     ref = deepcopy(x)
@@ -184,32 +411,34 @@ def fit_reference(
         ref = bandpass_signal(ref, center_fs=expected_fs, fs=fs, **bandpass_kwargs)
 
     ### fft on bp filtered signal to make sure matches input freq
-    cmp_fft = np.fft.fft(ref)
-    mx_fs = np.argmax(np.abs(cmp_fft))
-    hz = np.fft.fftfreq(ref.size, tstep)
-    detected_fs = np.abs(hz[mx_fs])
+    detected_fs = fft_peak_frequency(ref, tstep)
 
-    if np.abs(detected_fs - expected_fs) > 100:
+    if expected_fs is None:
+        expected_fs = detected_fs
+    elif np.abs(detected_fs - expected_fs) > 100:
         warnings.warn(
             "FFT detected center frequency {} while supplied frequency {}".format(
-                hz, expected_fs
+                detected_fs, expected_fs
             )
         )
 
-    # initialize best guesses of new params
-    init_vec = [np.nanstd(ref), expected_fs, 0, np.nanmean(ref)]
-
-    # calculate phase offset from input and reference signals and fill into init_vec
-    init_fit_angle = np.angle(
-        signal.hilbert(stats.zscore(gen_sine(init_vec, timestamps)))
-    )
-    data_angle = np.angle(signal.hilbert(ref.astype("float")))
-    phase_diff = -np.angle(np.mean(np.exp(1j * (init_fit_angle - data_angle))))
-    init_vec[2] = phase_diff
-
-    # fit params to bp filtered signal by minimizing SSE
-    obj_fun = lambda p: np.sum(get_residuals(p, signal=ref, timepoints=timestamps) ** 2)
-    new_params = optimize.fmin(obj_fun, init_vec, disp=False)
+    if method == "lstsq":
+        new_params, improved = _fit_sine_lstsq(
+            ref, timestamps, expected_fs, seed_fs=detected_fs, n_iter=n_iter
+        )
+        if not np.all(np.isfinite(new_params)):
+            warnings.warn("Least squares reference fit failed, falling back to fmin")
+        elif improved:
+            return new_params, gen_sine(new_params, timestamps), ref
+        else:
+            # no better than the fit at expected_fs: keep whichever of the two fits is best
+            fmin_params = _fit_sine_fmin(ref, timestamps, expected_fs)
+            sse = lambda p: np.sum(get_residuals(p, signal=ref, timepoints=timestamps) ** 2)
+            if sse(new_params) <= sse(fmin_params):
+                return new_params, gen_sine(new_params, timestamps), ref
+            return fmin_params, gen_sine(fmin_params, timestamps), ref
+
+    new_params = _fit_sine_fmin(ref, timestamps, expected_fs)
 
     return new_params, gen_sine(new_params, timestamps), ref
 
@@ -228,19 +457,77 @@ def spec_demodulate(z1_trace_list, calc_carry_list, sampling_Hz, num_perseg, n_o
         demodulated_trace_list.append(demodulated_trace)
     return demodulated_trace_list
             
-def calc_carry(raw_carrier_list, sampling_Hz):
-                calc_carry_list = []
-                points_2_process = 2**14
-                for i in range(len(raw_carrier_list)):
-                    fft_carrier = abs(np.fft.fft(raw_carrier_list[i][0:points_2_process]))
-                    P2 = fft_carrier/points_2_process
-                    P1 = abs(P2/2+1)
-                    P1[1:-1] = 2*P1[1:-1]
-                    f = sampling_Hz * np.arange(points_2_process // 2) / points_2_process
-                    ind = np.argmax(P1, axis=None)
-                    processed_carrier = round(f[ind])
-                    calc_carry_list.append(processed_carrier)
-                return calc_carry_list
+# detected carriers, keyed by a digest of the samples used and the detection settings
+_carrier_memo = OrderedDict()
+CARRIER_MEMO_SIZE = 256
+
+
+def calc_carry(raw_carrier_list, sampling_Hz, points_2_process=2**14, pad_factor=1, refine=False):
+
+    """
+    Detect the carrier frequency of each raw carrier trace from the peak of its
+    single-sided amplitude spectrum, using one 2-D real FFT for all traces
+    INPUTS:
+        raw_carrier_list: list of raw carrier traces
+        sampling_Hz: sampling frequency of the traces
+        points_2_process: number of leading samples used from each trace
+        pad_factor: zero-pad the FFT by this factor for a finer frequency grid
+        refine: parabolic interpolation around the peak for sub-bin accuracy
+    OUTPUTS:
+        calc_carry_list: carrier frequency per trace (rounded to Hz unless refine)
+    Results are memoised, so repeated calls on the same samples are free, and kept
+    in the stage cache across runs when it is enabled
+    """
+
+    settings = (float(sampling_Hz), points_2_process, pad_factor, refine)
+    keys = []
+    for carrier in raw_carrier_list:
+        snippet = np.ascontiguousarray(carrier[0:points_2_process])
+        digest = hashlib.blake2b(snippet.tobytes(), digest_size=16)
+        digest.update(str(snippet.dtype).encode())
+        keys.append((digest.hexdigest(),) + settings)
+
+    for key in keys:
+        if key not in _carrier_memo:
+            # detected by an earlier run
+            carrier_fs = stage_cache.load(stage_cache.stage_key("carriers", *key))
+            if carrier_fs is not None:
+                _carrier_memo[key] = carrier_fs
+
+    todo = {key: i for i, key in enumerate(keys) if key not in _carrier_memo}
+    if todo:
+        n_fft = points_2_process * pad_factor
+        batch = np.zeros((len(todo), points_2_process))
+        for row, i in enumerate(todo.values()):
+            snippet = raw_carrier_list[i][0:points_2_process]
+            batch[row, : len(snippet)] = snippet
+
+        P2 = np.abs(np.fft.rfft(batch, n=n_fft, axis=-1)) / points_2_process
+        del batch
+        P1 = np.abs(P2 / 2 + 1)
+        P1[:, 1:] = 2 * P1[:, 1:]
+        f = sampling_Hz * np.arange(P1.shape[-1]) / n_fft
+        ind = np.argmax(P1, axis=-1)
+
+        for row, key in enumerate(todo):
+            k = ind[row]
+            if refine and 0 < k < P1.shape[-1] - 1:
+                a, b, c = np.log(P2[row, k - 1 : k + 2] + np.finfo(float).tiny)
+                denom = a - 2 * b + c
+                shift = 0.5 * (a - c) / denom if denom != 0 else 0.0
+                carrier_fs = float(sampling_Hz * (k + shift) / n_fft)
+            else:
+                carrier_fs = float(f[k]) if refine else round(f[k])
+            _carrier_memo[key] = carrier_fs
+            stage_cache.store(stage_cache.stage_key("carriers", *key), carrier_fs)
+            while len(_carrier_memo) > CARRIER_MEMO_SIZE:
+                _carrier_memo.popitem(last=False)
+
+    calc_carry_list = []
+    for key in keys:
+        _carrier_memo.move_to_end(key)
+        calc_carry_list.append(_carrier_memo[key])
+    return calc_carry_list
 
 def four(z1_trace_list):
                 four_list = []
@@ -258,40 +545,534 @@ def bandpass_demod(demodulated_trace_list, calc_carry_list, sampling_Hz, bp_bw):
             bw=bp_bw)
         for trace, calc_carry in zip(demodulated_trace_list, calc_carry_list)]
 
-def process_trace(raw_photom_list, calc_carry_list, sampling_Hz, window1, num_perseg, n_overlap):
-    z1_trace_list = []
-    power_spectra_list = []
-    t_list = []
-    spect_power_list = []
-    
-    for i in range(len(raw_photom_list)):
-        z_trace = rolling_z(raw_photom_list[i], window1)
-        z1_trace_list.append(z_trace)
-        
-        # Rolling demodulation
-        win = signal.hamming(num_perseg, 'periodic')
-        power_spectra = []
-        t = []
-        f, t_, Zxx = signal.spectrogram(z_trace, sampling_Hz, window=win, nperseg=num_perseg, noverlap=n_overlap)
-        power_spectra.append(np.abs(Zxx))
-        t.append(t_)
-        t = np.concatenate(t)
-        power_spectra = np.concatenate(power_spectra, axis=1)
-        freq_ind = np.argmin(np.abs(f - np.array(calc_carry_list[i]).reshape((-1, 1))), axis=1)
-        rolling_demod = power_spectra[freq_ind, :][0]
-        power_spectra_list.append(rolling_demod)
-        t_list.append(t)
+def single_bin_spectrogram(x, carrier_fs, fs, window, nperseg, noverlap, block_size=2**14):
+
+    """
+    Evaluate the spectrogram of x only at the bin(s) closest to the carrier frequencies
+    Matches scipy.signal.spectrogram defaults (constant detrend, one-sided psd density)
+    INPUTS:
+        x: 1-D signal
+        carrier_fs: carrier frequency or list of carrier frequencies (Hz)
+        fs: sampling frequency of x
+        window: window array of length nperseg (or a scipy window name)
+        nperseg, noverlap: segment length and overlap in samples
+        block_size: number of segments evaluated per matrix product, bounds memory
+    OUTPUTS:
+        f: frequencies of the evaluated bins
+        t: segment centre times
+        Sxx: power at the evaluated bins, shape (n_carriers, n_segments)
+    """
+
+    x = np.asarray(x, dtype="float")
+    win = signal.get_window(window, nperseg) if isinstance(window, str) else np.asarray(window)
+    step = nperseg - noverlap
+    n_seg = (x.shape[-1] - noverlap) // step
+
+    # pick the same bins the full spectrogram would
+    f_all = np.fft.rfftfreq(nperseg, 1 / fs)
+    freq_ind = np.argmin(np.abs(f_all - np.array(carrier_fs).reshape((-1, 1))), axis=1)
+
+    # single-frequency DFT kernels (cos and -sin per bin), windowed; subtracting the
+    # kernel mean is equivalent to removing each segment's mean before windowing
+    phase = 2 * np.pi * np.outer(np.arange(nperseg), freq_ind) / nperseg
+    kernel = np.hstack([win[:, None] * np.cos(phase), -win[:, None] * np.sin(phase)])
+    kernel -= kernel.mean(axis=0)
+
+    scale = np.full(len(freq_ind), 1.0 / (fs * np.sum(win**2)))
+    nyquist = nperseg // 2 if nperseg % 2 == 0 else None
+    scale[(freq_ind != 0) & (freq_ind != nyquist)] *= 2
+
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg)[::step][:n_seg]
+    Sxx = np.empty((len(freq_ind), n_seg))
+    n_bins = len(freq_ind)
+    for start in range(0, n_seg, block_size):
+        proj = segments[start : start + block_size] @ kernel
+        Sxx[:, start : start + block_size] = (
+            proj[:, :n_bins] ** 2 + proj[:, n_bins:] ** 2
+        ).T
+
+    t = (np.arange(n_seg) * step + nperseg / 2) / fs
+    return f_all[freq_ind], t, Sxx * scale[:, None]
+
+
+def detector_groups(raw_photom_list):
+
+    """
+    Label traces that hold identical samples (i.e. read from the same photodetector)
+    OUTPUTS:
+        list with one group label per trace, identical traces share a label
+    """
+
+    groups = []
+    for i, x in enumerate(raw_photom_list):
+        for j in range(i):
+            y = raw_photom_list[j]
+            if x is y or (
+                np.shape(x) == np.shape(y)
+                and np.array_equal(x[:1024], y[:1024])
+                and np.array_equal(x, y)
+            ):
+                groups.append(groups[j])
+                break
+        else:
+            groups.append(i)
+    return groups
+
+
+def _share_array(x, blocks):
+    # copy x into a new shared memory block, keep the block so it can be unlinked
+    x = np.ascontiguousarray(x)
+    shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+    blocks.append(shm)
+    np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[:] = x
+    return shm.name, x.shape, x.dtype.str
+
+
+def _attach_array(spec):
+    # attach to a block created by _share_array (the parent owns and unlinks it)
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def run_shared(func, arrays, task_args, n_workers, output_lengths=None):
+
+    """
+    Run func(array_spec, output_spec, *args) for every array in a bounded process pool
+    Arrays (and optional float output buffers) are handed to the workers through
+    shared memory instead of being pickled
+    INPUTS:
+        func: module-level worker function, attaches to its specs with _attach_array
+        arrays: list of input arrays
+        task_args: list of extra argument tuples, one per array
+        n_workers: maximum number of worker processes
+        output_lengths: length of the float output buffer of each task (optional)
+    OUTPUTS:
+        results: return values of func, in the order of arrays
+        outputs: contents of the output buffers (None if output_lengths is None)
+    """
+
+    blocks = []
+    try:
+        in_specs = [_share_array(x, blocks) for x in arrays]
+        if output_lengths is None:
+            out_specs = [None] * len(arrays)
+        else:
+            out_specs = [_share_array(np.empty(n), blocks) for n in output_lengths]
+
+        with ProcessPoolExecutor(max_workers=max(1, min(n_workers, len(arrays)))) as pool:
+            futures = [
+                pool.submit(func, in_spec, out_spec, *args)
+                for in_spec, out_spec, args in zip(in_specs, out_specs, task_args)
+            ]
+            results = [future.result() for future in futures]
+
+        outputs = None
+        if output_lengths is not None:
+            outputs = []
+            for name, shape, dtype in out_specs:
+                shm = next(block for block in blocks if block.name == name)
+                outputs.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy())
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return results, outputs
+
+
+def _detector_power(z_trace, carriers, sampling_Hz, num_perseg, n_overlap, method):
+    # power at each carrier from one transform of a z-scored detector trace
+    win = hamming(num_perseg, sym=False)
+    if method == "single_bin":
+        _, t, power_spectra = single_bin_spectrogram(
+            z_trace, carriers, sampling_Hz, win, num_perseg, n_overlap
+        )
+    else:
+        f, t, Zxx = signal.spectrogram(z_trace, sampling_Hz, window=win, nperseg=num_perseg, noverlap=n_overlap)
+        freq_ind = np.argmin(np.abs(f - carriers.reshape((-1, 1))), axis=1)
+        power_spectra = np.abs(Zxx[freq_ind, :])
+    return t, power_spectra
+
+
+def _process_detector_shared(raw_spec, z_spec, carriers, sampling_Hz, window1, num_perseg,
+                             n_overlap, method):
+    # process_trace worker: z-scored trace goes back through shared memory
+    raw_shm, raw = _attach_array(raw_spec)
+    z_shm, z_out = _attach_array(z_spec)
+    try:
+        z_out[:] = rolling_z(raw, window1)
+        t, power_spectra = _detector_power(z_out, carriers, sampling_Hz, num_perseg, n_overlap, method)
+    finally:
+        del raw, z_out
+        raw_shm.close()
+        z_shm.close()
+    return t, power_spectra
+
+
+def default_memory_budget():
+
+    """
+    Half of the memory available to this process, in bytes
+    Uses the container (cgroup) limit when there is one, physical memory otherwise
+    """
+
+    limits = []
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                limits.append(int(f.read().strip()))
+        except (OSError, ValueError):
+            pass
+    try:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (AttributeError, ValueError, OSError):
+        pass
+    return min(limits) // 2 if limits else None
+
+
+def estimate_trace_memory(n_samples, n_detectors, num_perseg, n_overlap, method="spectrogram",
+                          n_workers=1):
+
+    """
+    Approximate peak memory (bytes) of process_trace holding whole traces in memory
+    INPUTS:
+        n_samples: samples per raw trace
+        n_detectors: number of traces transformed (after grouping)
+        num_perseg, n_overlap, method: as in process_trace
+        n_workers: detectors transformed at the same time
+    """
+
+    step = num_perseg - n_overlap
+    n_seg = max(0, (n_samples - n_overlap) // step)
+    # every z-scored trace is kept, and copied into shared memory with the raw traces
+    held = 8 * n_samples * n_detectors * (3 if n_workers > 1 else 1)
+    if method == "spectrogram":
+        # detrended and windowed segments, complex spectrum and its power
+        transient = 8 * n_seg * (2 * num_perseg + 3 * (num_perseg // 2 + 1))
+    else:
+        # float64 copy of the trace and one block of segments
+        transient = 8 * n_samples + 8 * 2**14 * num_perseg
+    return held + min(n_workers, n_detectors) * transient
+
+
+def _blocked_detector_power(raw, carriers, sampling_Hz, window1, num_perseg, n_overlap, method,
+                            block_size):
+    # _detector_power over blocks of whole segments, z-scoring each block on the fly
+    step = num_perseg - n_overlap
+    n_seg = (len(raw) - n_overlap) // step
+    seg_per_block = max(1, block_size // step)
+    power_spectra = np.empty((len(carriers), n_seg))
+    for first in range(0, n_seg, seg_per_block):
+        last = min(first + seg_per_block, n_seg)
+        z_block = rolling_z_block(raw, window1, first * step, (last - 1) * step + num_perseg)
+        _, power_spectra[:, first:last] = _detector_power(
+            z_block, carriers, sampling_Hz, num_perseg, n_overlap, method
+        )
+    t = (np.arange(n_seg) * step + num_perseg / 2) / sampling_Hz
+    return t, power_spectra
+
+
+def _group_detectors(raw_photom_list, calc_carry_list, groups):
+    # trace indices and carriers of each detector, in order of first appearance
+    if groups is None:
+        groups = detector_groups(raw_photom_list)
+    detectors = {}
+    for i, group in enumerate(groups):
+        detectors.setdefault(group, []).append(i)
+    members_list = list(detectors.values())
+    carriers_list = [np.array([calc_carry_list[i] for i in members]) for members in members_list]
+    return members_list, carriers_list
+
+
+def _carrier_power_key(raw_digest, carriers, sampling_Hz, window1, num_perseg, n_overlap, method):
+    # stage cache key of a detector's carrier power
+    return stage_cache.stage_key(
+        "carrier_power", raw_digest, carriers, sampling_Hz, window1, num_perseg, n_overlap, method
+    )
+
+
+def _stack_traces(traces):
+    # one row per trace, traces of unequal lengths (e.g. stores of different lengths) stay a list
+    if len({len(trace) for trace in traces}) > 1:
+        return list(traces)
+    return np.array(traces)
+
+
+def process_trace(raw_photom_list, calc_carry_list, sampling_Hz, window1, num_perseg, n_overlap,
+                  method="spectrogram", groups=None, n_workers=1, memory_budget=None,
+                  block_size=None):
+
+    """
+    Rolling z-score each raw trace and extract power at its carrier frequency
+    method: "spectrogram" computes the full spectrogram and keeps the carrier row,
+            "single_bin" evaluates only the carrier bin per segment (same output)
+    groups: detector label per trace; traces sharing a label are z-scored and
+            transformed once with all of their carriers extracted from that pass.
+            Detected from identical input arrays if not given.
+    n_workers: number of processes used to demodulate detectors in parallel
+    memory_budget: bytes the demodulation may use; when the estimated working set is
+            larger, traces are processed in blocks of whole segments instead
+            (z-scoring included), one detector at a time, and the z-scored traces
+            are not returned (None)
+    block_size: samples per block, forces blocked processing when given
+    Outputs are 2-D arrays with one row per trace, or lists of rows when the raw
+    traces differ in length
+    With the stage cache enabled, the carrier power of each detector is cached under
+    its raw samples and parameters; z-scored traces of cached detectors are None
+    """
+
+    if method not in ("spectrogram", "single_bin"):
+        raise ValueError("Did not understand demodulation method {}".format(method))
+
+    members_list, carriers_list = _group_detectors(raw_photom_list, calc_carry_list, groups)
+
+    # carrier power of detectors demodulated by an earlier run
+    power_keys, cached = {}, {}
+    if stage_cache.get_stage_cache_dir() is not None:
+        for d, (members, carriers) in enumerate(zip(members_list, carriers_list)):
+            power_keys[d] = _carrier_power_key(
+                stage_cache.array_digest(raw_photom_list[members[0]]), carriers, sampling_Hz,
+                window1, num_perseg, n_overlap, method,
+            )
+            power = stage_cache.load(power_keys[d])
+            if power is not None:
+                cached[d] = power
+    todo = [d for d in range(len(members_list)) if d not in cached]
+    raw_traces = [raw_photom_list[members_list[d][0]] for d in todo]
+    todo_carriers = [carriers_list[d] for d in todo]
+
+    if todo and block_size is None and memory_budget is not None:
+        n_samples = max(len(x) for x in raw_traces)
+        needed = estimate_trace_memory(
+            n_samples, len(todo), num_perseg, n_overlap, method, n_workers
+        )
+        if needed > memory_budget:
+            # one block's working set, with room for the rolling temporaries, fits the budget
+            per_sample = estimate_trace_memory(2**20, 1, num_perseg, n_overlap, method) / 2**20
+            block_size = max(
+                int(memory_budget // (2 * per_sample)), 4 * window1, 64 * (num_perseg - n_overlap)
+            )
+
+    if block_size is not None:
+        # out-of-core: one detector and one block at a time, z-scored traces are not kept
+        results = [
+            _blocked_detector_power(raw, carriers, sampling_Hz, window1,
+                                    num_perseg, n_overlap, method, block_size)
+            for raw, carriers in zip(raw_traces, todo_carriers)
+        ]
+        z_traces = [None] * len(todo)
+    elif n_workers > 1 and len(todo) > 1:
+        results, z_traces = run_shared(
+            _process_detector_shared,
+            raw_traces,
+            [(carriers, sampling_Hz, window1, num_perseg, n_overlap, method)
+             for carriers in todo_carriers],
+            n_workers,
+            output_lengths=[len(x) for x in raw_traces],
+        )
+    else:
+        results, z_traces = [], []
+        for raw, carriers in zip(raw_traces, todo_carriers):
+            z_trace = rolling_z(raw, window1)
+            z_traces.append(z_trace)
+            # Rolling demodulation, one transform per detector
+            results.append(
+                _detector_power(z_trace, carriers, sampling_Hz, num_perseg, n_overlap, method)
+            )
+
+    for d, result in zip(todo, results):
+        if d in power_keys:
+            stage_cache.store(power_keys[d], result)
+    results = {**cached, **dict(zip(todo, results))}
+    z_traces = dict(zip(todo, z_traces))
+
+    n_traces = len(raw_photom_list)
+    z1_trace_list = [None] * n_traces
+    power_spectra_list = [None] * n_traces
+    t_list = [None] * n_traces
+    for d, members in enumerate(members_list):
+        t, power_spectra = results[d]
+        for row, i in enumerate(members):
+            z1_trace_list[i] = z_traces.get(d)
+            power_spectra_list[i] = power_spectra[row]
+            t_list[i] = t
 
     #spect_power = np.mean(rolling_demod, axis=0)
-    spect_power_list.append(rolling_demod) #instead of spect power, no averaging needed
-    
-    power_spectra_list = np.array(power_spectra_list)
-    t_list = np.array(t_list)
-    spect_power_list = np.array(spect_power_list)
+    spect_power_list = power_spectra_list #instead of spect power, no averaging needed
+
+    power_spectra_list = _stack_traces(power_spectra_list)
+    t_list = _stack_traces(t_list)
+    spect_power_list = _stack_traces(spect_power_list)
 
     return z1_trace_list, power_spectra_list, t_list, spect_power_list
              
 
+def process_trace_variants(raw_photom_list, calc_carry_list, sampling_Hz, variants, groups=None):
+
+    """
+    process_trace for several parameter sets from one copy of the raw traces
+    INPUTS:
+        raw_photom_list, calc_carry_list, sampling_Hz, groups: as in process_trace
+        variants: list of dicts with window1, num_perseg, n_overlap and method
+    OUTPUTS:
+        spect_power_list of each variant, in the order of variants (a list of rows when
+        the raw traces differ in length)
+    Each detector is z-scored once per distinct window1 and transformed once per
+    variant; with the stage cache enabled, cached carrier power is reused
+    """
+
+    for variant in variants:
+        if variant["method"] not in ("spectrogram", "single_bin"):
+            raise ValueError("Did not understand demodulation method {}".format(variant["method"]))
+
+    members_list, carriers_list = _group_detectors(raw_photom_list, calc_carry_list, groups)
+    caching = stage_cache.get_stage_cache_dir() is not None
+    windows = list(dict.fromkeys(variant["window1"] for variant in variants))
+
+    spect_power_lists = [[None] * len(raw_photom_list) for _ in variants]
+    for members, carriers in zip(members_list, carriers_list):
+        raw = raw_photom_list[members[0]]
+        raw_digest = stage_cache.array_digest(raw) if caching else None
+        for window1 in windows:
+            z_trace = None
+            for v, variant in enumerate(variants):
+                if variant["window1"] != window1:
+                    continue
+                key = _carrier_power_key(
+                    raw_digest, carriers, sampling_Hz, window1, variant["num_perseg"],
+                    variant["n_overlap"], variant["method"],
+                )
+                result = stage_cache.load(key) if caching else None
+                if result is None:
+                    if z_trace is None:
+                        z_trace = rolling_z(raw, window1)
+                    result = _detector_power(z_trace, carriers, sampling_Hz, variant["num_perseg"],
+                                             variant["n_overlap"], variant["method"])
+                    if caching:
+                        stage_cache.store(key, result)
+                _, power_spectra = result
+                for row, i in enumerate(members):
+                    spect_power_lists[v][i] = power_spectra[row]
+            del z_trace
+
+    return [_stack_traces(spect_power_list) for spect_power_list in spect_power_lists]
+
+
+class StreamingDemodulator:
+
+    """
+    Incremental version of process_trace for one detector, fed with raw sample chunks
+    as they are acquired. Emits the carrier power of every segment as soon as the
+    rolling z-score of all its samples is known; the concatenated output equals
+    process_trace on the whole recording (to floating point tolerance).
+    INPUTS:
+        carriers: carrier frequency or list of carrier frequencies of the detector (Hz)
+        sampling_Hz, window1, num_perseg, n_overlap, method: as in process_trace
+    Usage:
+        demod = StreamingDemodulator([carrier_g, carrier_r], sampling_Hz, window1)
+        for chunk in acquisition:
+            t, power = demod.push(chunk)  # power: (n_carriers, new segments)
+        t, power = demod.finish()
+    """
+
+    def __init__(self, carriers, sampling_Hz, window1, num_perseg=216, n_overlap=108,
+                 method="single_bin"):
+        if method not in ("spectrogram", "single_bin"):
+            raise ValueError("Did not understand demodulation method {}".format(method))
+        self.carriers = np.atleast_1d(np.asarray(carriers, dtype="float"))
+        self.sampling_Hz = sampling_Hz
+        self.window1 = window1
+        self.num_perseg = num_perseg
+        self.n_overlap = n_overlap
+        self.method = method
+        self.step = num_perseg - n_overlap
+
+        self.n_samples = 0  # raw samples received
+        self._raw = np.empty(0)  # raw samples from global position self._raw_start on
+        self._raw_start = 0
+        self._z = np.empty(0)  # z-scores from global position self._z_start on
+        self._z_start = 0
+        self._next_segment = 0
+        self._finished = False
+
+    @property
+    def latency(self):
+        """Samples between the end of a segment and the chunk that completes it"""
+        # the z-score of the last segment sample is final once the tail of
+        # rolling_z can no longer reach it
+        return -(-self.window1 // 2) + 1
+
+    def _segments(self, n_seg):
+        # power of the segments [self._next_segment, n_seg) from the buffered z-scores
+        first = self._next_segment
+        if n_seg <= first:
+            return np.empty(0), np.empty((len(self.carriers), 0))
+        z_block = self._z[first * self.step - self._z_start :
+                          (n_seg - 1) * self.step + self.num_perseg - self._z_start]
+        t, power_spectra = _detector_power(
+            z_block, self.carriers, self.sampling_Hz, self.num_perseg, self.n_overlap,
+            self.method,
+        )
+        self._next_segment = n_seg
+        # drop z-scores no later segment needs
+        keep_from = n_seg * self.step
+        self._z = self._z[keep_from - self._z_start :]
+        self._z_start = keep_from
+        return t + first * self.step / self.sampling_Hz, power_spectra
+
+    def push(self, chunk):
+
+        """
+        Add raw samples
+        OUTPUTS:
+            t: centre times of the segments completed by this chunk
+            power_spectra: their carrier power, shape (n_carriers, n_new_segments)
+        """
+
+        if self._finished:
+            raise RuntimeError("StreamingDemodulator is finished")
+        chunk = np.asarray(chunk, dtype="float").ravel()
+        self._raw = np.concatenate([self._raw, chunk])
+        self.n_samples += len(chunk)
+
+        wn, lead = self.window1, self.window1 // 2
+        z_start = self._z_start + len(self._z)
+        # z-scores that the end-of-recording zeroing can no longer touch
+        z_stop = self.n_samples - self.latency + 1
+        if z_stop > z_start:
+            lo = max(0, z_start - lead)
+            hi = z_stop - lead + wn - 1
+            z = rolling_zscore(
+                self._raw[lo - self._raw_start : hi - self._raw_start], wn
+            )[z_start - lo : z_stop - lo]
+            z[: max(0, lead - z_start)] = 0
+            self._z = np.concatenate([self._z, z])
+            keep_from = max(0, z_stop - lead)
+            self._raw = self._raw[keep_from - self._raw_start :]
+            self._raw_start = keep_from
+
+        z_end = self._z_start + len(self._z)
+        return self._segments(max(0, (z_end - self.n_overlap) // self.step))
+
+    def finish(self):
+
+        """
+        End of recording: emit the remaining segments
+        OUTPUTS:
+            t, power_spectra: as push
+        """
+
+        if self._finished:
+            raise RuntimeError("StreamingDemodulator is finished")
+        self._finished = True
+        # every z-score not yet computed lies in the zeroed tail of rolling_z
+        z_end = self._z_start + len(self._z)
+        self._z = np.concatenate([self._z, np.zeros(self.n_samples - z_end)])
+        self._raw = np.empty(0)
+        return self._segments(max(0, (self.n_samples - self.n_overlap) // self.step))
+
+
 def demodulate(
     x,
     center_fs,
@@ -308,8 +1089,17 @@ def demodulate(
     downsample_antialias=True,
     pre_downsample=True,
     bandpass_bw=50,
+    dtype=None,
 ):
 
+    """
+    Lock-in demodulation of x against in-phase (ref_x) and quadrature (ref_y) references
+    x may be 2-D (n_traces, n_samples) to demodulate several traces in one batch:
+    center_fs is then a scalar or one value per row and the references broadcast
+    against x. The I/Q products are stacked so every filter runs once along axis -1.
+    dtype: optional working dtype, e.g. float32 to halve memory traffic
+    """
+
     assert downsample_fs < fs, "Downsample fs must be lower than original fs"
 
     if ref_x is None or ref_y is None:
@@ -319,7 +1109,8 @@ def demodulate(
     demod_samples = int(demod_tau * downsample_fs)
 
     # get the product operators, then integrate and combine
-    sig = deepcopy(x)
+    sig = np.asarray(x) if dtype is None else np.asarray(x, dtype=dtype)
+    work_dtype = np.result_type(sig.dtype, np.float32)
 
     if mod_bandpass:
         sig = bandpass_signal(
@@ -328,81 +1119,207 @@ def demodulate(
 
     # get rms for x and y, downsample before r, multiply nyquist by .8 so we have headroom
 
-    mult_x = np.square(sig * ref_x)
-    mult_y = np.square(sig * ref_y)
+    mult = np.empty((2,) + sig.shape, dtype=work_dtype)
+    np.multiply(sig, ref_x, out=mult[0], casting="same_kind")
+    np.multiply(sig, ref_y, out=mult[1], casting="same_kind")
+    del sig
+    np.square(mult, out=mult)
 
     if pre_downsample:
         if downsample_antialias:
-            sos = signal.butter(
+            sos, stable = design_sos(
+                "butter",
                 downsample_filter_order,
                 0.8 * (downsample_fs / 2),
-                btype="low",
-                fs=fs,
-                output="sos",
+                "low",
+                fs,
             )
-            if not is_filter_stable(sos):
+            if not stable:
                 raise ValueError(
                     "Downsample filter unstable, change your filter specifications"
                 )
-            mult_x = signal.sosfiltfilt(sos, mult_x)
-            mult_y = signal.sosfiltfilt(sos, mult_y)
+            mult = signal.sosfiltfilt(sos.astype(work_dtype), mult, axis=-1)
 
-            mult_x = downsample(mult_x, fs, downsample_fs, method=downsample_method)
-            mult_y = downsample(mult_y, fs, downsample_fs, method=downsample_method)
+            mult = downsample(mult, fs, downsample_fs, method=downsample_method)
 
     # final round of filtering
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
-        sos = signal.ellip(
+        sos, stable = design_sos(
+            "ellip",
             demod_filter_order,
-            0.1,
-            40,
             demod_fs,
-            btype="low",
-            fs=downsample_fs,
-            output="sos",
+            "low",
+            downsample_fs,
+            ripple=0.1,
+            attenuation=40,
         )
 
-        if not is_filter_stable(sos):
+        if not stable:
             raise ValueError(
                 "Integration filter is not stable, change your design specifications"
             )
 
-        int_x = np.sqrt(signal.sosfiltfilt(sos, mult_x))
-        int_y = np.sqrt(signal.sosfiltfilt(sos, mult_y))
+        integrated = np.sqrt(signal.sosfiltfilt(sos.astype(work_dtype), mult, axis=-1))
+        int_x, int_y = integrated[0], integrated[1]
         r = np.hypot(int_x, int_y)
 
-    r[:demod_samples] = np.nan
-    r[-demod_samples:] = np.nan
-    int_y[:demod_samples] = np.nan
-    int_y[-demod_samples:] = np.nan
-    int_x[:demod_samples] = np.nan
-    int_x[-demod_samples:] = np.nan
+    r[..., :demod_samples] = np.nan
+    r[..., -demod_samples:] = np.nan
+    int_y[..., :demod_samples] = np.nan
+    int_y[..., -demod_samples:] = np.nan
+    int_x[..., :demod_samples] = np.nan
+    int_x[..., -demod_samples:] = np.nan
 
     return int_x, int_y, r, downsample_fs
 
 
-def rolling_z(x, wn):
-    x = pd.Series(x)
-    xbar = x.rolling(wn, center=True).mean()
-    xstd = x.rolling(wn, center=True).std()
+def rolling_z(x, wn, dtype="float64", chunk_size=2**20):
+
+    """
+    Centred rolling z-score with the window tails set to zero
+    dtype: output dtype, float32 halves memory for long raw traces
+    chunk_size: samples computed per block, bounds peak memory
+    """
 
-    z = (x - xbar) / xstd
+    z = rolling_zscore(x, wn, dtype=dtype, chunk_size=chunk_size)
     z[: wn // 2] = 0
     z[-wn // 2 :] = 0
-    return z.values
+    return z
+
+
+def rolling_z_block(x, wn, start, stop, dtype="float64", chunk_size=2**20):
+
+    """
+    rolling_z(x, wn)[start:stop], computed from the samples it depends on only
+    so long (e.g. memory-mapped) traces can be z-scored one block at a time
+    """
+
+    n = len(x)
+    lo = max(0, start - wn // 2)
+    hi = min(n, stop - wn // 2 + wn - 1)
+    z = rolling_zscore(x[lo:hi], wn, dtype=dtype, chunk_size=chunk_size)[start - lo : stop - lo]
+    # same tails as rolling_z, in global sample positions
+    z[: max(0, wn // 2 - start)] = 0
+    z[max(0, n + (-wn // 2) - start) :] = 0
+    return z
+
+
+
+def _fit_amplitude_offset(x, timestamps, params, fs, bandpass=True):
+    # amplitude and offset of x for a reference with known frequency and phase
+    if bandpass:
+        x = bandpass_signal(x, center_fs=params[1], fs=fs)
+    design = np.column_stack(
+        [np.sin(2 * np.pi * timestamps * params[1] + params[2]), np.ones_like(timestamps)]
+    )
+    (amplitude, offset), *_ = np.linalg.lstsq(design, x, rcond=None)
+    return (amplitude, params[1], params[2], offset)
+
+
+def _demodulate_fiber(sig, ref_fs, fs, tau, z, z_window, downsample_fs, bandpass_bw, use_points):
+
+    """
+    Demodulate a single fiber's photometry signal with a fitted offline reference
+    OUTPUTS:
+        detrend: demodulated (rolling z-scored if z) signal
+        raw: demodulated signal without the z-score (None if z is False)
+    """
+
+    tstamps = np.arange(len(sig)) / fs # CB: timestamps to track samples
+    snippet = slice(int(z_window*fs), int(z_window*fs)+use_points) # jump over z-score window tails (or equivalent to match)
+
+    # stage outputs are cached under the raw signal digest chained with each stage's
+    # parameters, so only the stages downstream of a changed parameter are recomputed
+    sig_key = stage_cache.stage_key(
+        "signal",
+        stage_cache.array_digest(sig) if stage_cache.get_stage_cache_dir() is not None else None,
+        fs, z, z_window,
+    )
+
+    signals = []
+    def get_signals():
+        # z-scored (detrend) and, if z, raw signal, computed on first use only
+        if not signals:
+            if z:
+                signals.append(np.stack([rolling_z(sig, wn=round(z_window*fs)), sig]))
+                print('applying first z-score with a 60s rolling window')
+            else:
+                signals.append(np.asarray(sig)[None])
+        return signals[0]
+
+    def fit():
+        # frequency and phase are shared by the z-scored and raw signals, only the
+        # amplitude and offset of the raw reference are re-estimated
+        params_x, _, _ = fit_reference(get_signals()[0][snippet],
+                                       tstamps[snippet],
+                                       expected_fs=ref_fs) # CB: fitting sine measured wave in data; outputs fit params
+        params = [params_x]
+        if z:
+            params.append(_fit_amplitude_offset(sig[snippet], tstamps[snippet], params_x, fs))
+        return np.array(params)
+
+    ref_key = stage_cache.stage_key("reference_fit", sig_key, ref_fs, use_points)
+    params_x = stage_cache.cached_stage(ref_key, fit)
+
+    bandpass_key = stage_cache.stage_key("bandpass", sig_key, ref_fs, bandpass_bw)
+    bandpassed = stage_cache.cached_stage(
+        bandpass_key,
+        lambda: bandpass_signal(get_signals(), center_fs=ref_fs, fs=fs, attenuation=40,
+                                bw=bandpass_bw),
+    )
 
+    def demod():
+        ref = {}
+        ref["params_x"] = np.asarray(params_x)
+        # remember y has a 90 degree phase shift
+        ref["params_y"] = ref["params_x"] + [0, 0, np.pi / 2, 0]
+        # CB: generate new reference sines using fit params for data (y shifted 90 deg)
+        ref["ref_x"] = gen_sine(ref["params_x"].T[:, :, None], tstamps)
+        ref["ref_y"] = gen_sine(ref["params_y"].T[:, :, None], tstamps)
+
+        # demodulate the z-scored and raw signals as one batch
+        _, _, demod_sigs, _ = demodulate(bandpassed,
+                                         ref_fs, #is this the center_fs? and what is the center_fs
+                                         ref_x=ref["ref_x"],
+                                         ref_y=ref["ref_y"],
+                                         demod_tau=tau,
+                                         downsample_fs=downsample_fs,
+                                         bandpass_bw=bandpass_bw,
+                                         mod_bandpass=False)
+        return demod_sigs
+
+    demod_key = stage_cache.stage_key("demodulated", bandpass_key, ref_key, tau, downsample_fs)
+    demod_sigs = np.array(stage_cache.cached_stage(demod_key, demod))
+
+    demod_sigs[:, :int(z_window*downsample_fs)] = np.nan
+    demod_sigs[:, -int(z_window*downsample_fs):] = np.nan
+    return demod_sigs[0], (demod_sigs[1] if z else None)
+
+
+def _demodulate_fiber_shared(sig_spec, _, *args):
+    # offline_demodulation worker
+    sig_shm, sig = _attach_array(sig_spec)
+    try:
+        return _demodulate_fiber(sig, *args)
+    finally:
+        del sig
+        sig_shm.close()
 
 
 def offline_demodulation(data, metadata, tau=20, z=True, z_window=60, downsample_fs=600, 
-                         bandpass_bw=50, **kwargs):
-        
+                         bandpass_bw=50, n_workers=1, **kwargs):
+
+    """
+    Demodulate every fiber in data against a fitted offline reference
+    With z=True the rolling z-scored (detrend_*) and raw (raw_*) demodulations are
+    produced in the same pass, sharing sync downsampling and reference fits
+    """
+
     # use a short snippet of the signal to fit our offline reference
     use_points = int(1e4)     
             
-    tstamps, ref, demod_sig = {}, {}, {}
-        
     if metadata.task_ID.values[0].startswith('hf'):
         threshold = 0.5# ... # 0.5?
         toBeh = (downsample(data['toBeh'], metadata.sampling_freq.values[0], downsample_fs, 
@@ -412,55 +1329,27 @@ def offline_demodulation(data, metadata, tau=20, z=True, z_window=60, downsample
     
     demod_df = pd.DataFrame(data={'toBehSys':toBeh, 
                                   'fromBehSys':froG})
-    
-    for fiber in [col for col in data.columns if col.startswith('fiber')]:
-    
-        sig = data[fiber].values # photometry signal
-        ref_fs = metadata.loc[fiber, 'carrier_freq']
-        fs = metadata.loc[fiber, 'sampling_freq']
-        if z:
-            sig = rolling_z(sig, wn=round(z_window*fs))
-            print('applying first z-score with a 60s rolling window')
-             
-        tstamps = np.arange(len(sig)) / fs # CB: timestamps to track samples
 
-        results = fit_reference(sig[int(z_window*fs):int(z_window*fs)+use_points],  # jump over z-score window tails (or equivalent to match)
-                                tstamps[int(z_window*fs):int(z_window*fs)+use_points], 
-                                expected_fs=ref_fs) # CB: TBD but think this is fitting sine measured wave in raw data
-                                                       # and comparing to input sine wave parameters for driver; outputs fit params
-        ref["params_x"], _, _ = results # CB: deconstruct above into fit params and bp filtered data
-        # remember y has a 90 degree phase shift
-        ref["params_y"] = (ref["params_x"][0], #
-                           ref["params_x"][1],
-                           ref["params_x"][2] + np.pi / 2,
-                           ref["params_x"][3])
-        ref["ref_x"] = gen_sine(ref["params_x"], tstamps) # CB: generate new reference sine using fit params for data
-        ref["ref_y"] = gen_sine(ref["params_y"], tstamps) # CB: same but for shifted 90 deg
-
-        _, _, demod_sig, _ = demodulate(sig, 
-                                         ref_fs, #is this the center_fs? and what is the center_fs
-                                         ref_x=ref["ref_x"],
-                                         ref_y=ref["ref_y"],
-                                         demod_tau=tau,
-                                         downsample_fs=downsample_fs,
-                                         bandpass_bw=bandpass_bw)
-              
-        demod_sig[:int(z_window*downsample_fs)] = np.nan
-        demod_sig[-int(z_window*downsample_fs):] = np.nan
+    fibers = [col for col in data.columns if col.startswith('fiber')]
+    fiber_args = [(metadata.loc[fiber, 'carrier_freq'], metadata.loc[fiber, 'sampling_freq'],
+                   tau, z, z_window, downsample_fs, bandpass_bw, use_points) for fiber in fibers]
+
+    if n_workers > 1 and len(fibers) > 1:
+        demod_sigs, _ = run_shared(_demodulate_fiber_shared,
+                                   [data[fiber].values for fiber in fibers],
+                                   fiber_args, n_workers)
+    else:
+        demod_sigs = [_demodulate_fiber(data[fiber].values, *args)
+                      for fiber, args in zip(fibers, fiber_args)]
+
+    for fiber, (demod_sig, _) in zip(fibers, demod_sigs):
         demod_df[fiber.replace('fiber', 'detrend')] = demod_sig
+    if z:
+        for fiber, (_, raw_sig) in zip(fibers, demod_sigs):
+            demod_df[fiber.replace('fiber', 'raw')] = raw_sig
             
     start_idx = demod_df[fiber.replace('fiber', 'detrend')].first_valid_index()
     end_idx = demod_df[fiber.replace('fiber', 'detrend')].last_valid_index()
     demod_df = demod_df[start_idx:end_idx].reset_index(drop=True)
-                     
-    if z:
-        raw = offline_demodulation(data, metadata, tau, z=False,
-                                   downsample_fs=downsample_fs, 
-                                   bandpass_bw=bandpass_bw, **kwargs)
-        print(raw.columns)
-        assert(demod_df[['toBehSys','fromBehSys']].equals(raw[['toBehSys','fromBehSys']]))
-        for fiber in [col for col in data.columns if col.startswith('fiber')]:
-            side = fiber[len('fiber_'):]
-            demod_df[fiber.replace('fiber', 'raw')] = raw[f'detrend_{side}']
     
-    return demod_df
\ No newline at end of file
+    return demod_df
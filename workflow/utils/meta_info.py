@@ -0,0 +1,209 @@
+"""
+Session metadata from the .toml files in the Photometry and Behavior folders
+
+The file is parsed and validated once and cached by its modification time, so
+malformed files are rejected before any raw data is read, and per-fiber and
+per-colour settings are plain attribute lookups.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+import tomli
+
+COLOR_MAPPING = {"g": "green", "r": "red", "b": "blue"}
+SIDE_TO_FIBER_ID_MAPPING = {"right": 1, "left": 2, "middle": 3}
+TRANSFORMS = ("spectrogram", "single_bin", "hilbert")
+
+# parsed files, keyed by path and validated against (mtime, size)
+_meta_info_cache = {}
+
+
+class MetaInfoError(ValueError):
+    """The .toml meta info file is malformed"""
+
+
+@dataclass(frozen=True)
+class ColorInfo:
+    """Settings of one emission colour of a fiber"""
+    color: str
+    photom_index: int | None = None
+    carrier_index: int | None = None
+    emission_wavelength: int | None = None
+    excitation_wavelength: int | None = None
+    sensor_protein: str | None = None
+
+
+@dataclass(frozen=True)
+class FiberInfo:
+    """Settings of one fiber (hemisphere)"""
+    side: str
+    fiber_id: int
+    notes: str | None = None
+    colors: dict = field(default_factory=dict)  # {"g": ColorInfo, "r": ColorInfo}
+
+    @property
+    def channel_indices(self):
+        """Raw channel indices of this fiber's photometry and carrier traces"""
+        return sorted({
+            index for color in self.colors.values()
+            for index in (color.photom_index, color.carrier_index) if index is not None
+        })
+
+
+@dataclass(frozen=True)
+class Channel:
+    """One row of the channel table: a raw channel used by a fiber, colour and role"""
+    side: str
+    fiber_id: int
+    color: str  # "g", "r" or "b"
+    role: str  # "photom" or "carrier"
+    index: int  # raw channel index
+
+
+@dataclass(frozen=True)
+class MetaInfo:
+    """Parsed and validated .toml meta info of a session"""
+    path: Path
+    raw: dict  # the parsed file, for settings without a typed field
+    light_source: str = ""
+    processing_parameters: dict = field(default_factory=dict)
+    fibers: dict = field(default_factory=dict)  # {"right": FiberInfo, "left": FiberInfo}
+
+    @property
+    def sampling_frequency(self):
+        return self.processing_parameters.get("sampling_frequency")
+
+    @property
+    def transform(self):
+        return self.processing_parameters.get("transform")
+
+    @property
+    def channel_indices(self):
+        """Raw channel indices used by any fiber"""
+        return sorted({index for fiber in self.fibers.values() for index in fiber.channel_indices})
+
+    @property
+    def channels(self):
+        """Channel table (fiber x colour x role) of the channels listed in Signal_Indices"""
+        return [
+            Channel(side, fiber.fiber_id, letter, role, index)
+            for side, fiber in sorted(self.fibers.items(), key=lambda item: item[1].fiber_id)
+            for letter, color in fiber.colors.items()
+            for role, index in (("photom", color.photom_index), ("carrier", color.carrier_index))
+            if index is not None
+        ]
+
+
+def _optional_int(value, name):
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise MetaInfoError(f"{name} must be an integer, got {value!r}")
+    return value
+
+
+def _parse(path: Path, meta_info: dict, require_signals: bool) -> MetaInfo:
+    processing_parameters = meta_info.get("Processing_Parameters", {})
+    if not isinstance(processing_parameters, dict):
+        raise MetaInfoError("Processing_Parameters must be a table")
+
+    transform = processing_parameters.get("transform")
+    if transform is not None and transform not in TRANSFORMS:
+        raise MetaInfoError(f"Unknown transform {transform!r}, expected one of {TRANSFORMS}")
+    for name in ("sampling_frequency", "z_window"):
+        value = processing_parameters.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                  or value <= 0):
+            raise MetaInfoError(f"Processing_Parameters.{name} must be a positive number")
+
+    signal_indices = meta_info.get("Signal_Indices")
+    if signal_indices is None:
+        if require_signals:
+            raise MetaInfoError("Signal_Indices table is missing")
+        signal_indices = {}
+    if require_signals and processing_parameters.get("sampling_frequency") is None:
+        raise MetaInfoError("Processing_Parameters.sampling_frequency is missing")
+    total_channels = signal_indices.get("total_channels")
+
+    implantation = meta_info.get("Fiber", {}).get("implantation", {})
+    fibers = {}
+    for side, fiber_id in SIDE_TO_FIBER_ID_MAPPING.items():
+        indices = signal_indices.get(side)
+        if indices is None:
+            continue
+        colors = {}
+        for letter, color in COLOR_MAPPING.items():
+            color_info = ColorInfo(
+                color=color,
+                photom_index=_optional_int(indices.get(f"photom_{letter}"),
+                                           f"Signal_Indices.{side}.photom_{letter}"),
+                carrier_index=_optional_int(indices.get(f"carrier_{letter}"),
+                                            f"Signal_Indices.{side}.carrier_{letter}"),
+                emission_wavelength=indices.get("emission_wavelength", {}).get(color),
+                excitation_wavelength=indices.get("excitation_wavelength", {}).get(color),
+                sensor_protein=indices.get("sensor_protein", {}).get(color),
+            )
+            for index in (color_info.photom_index, color_info.carrier_index):
+                if index is not None and (index < 0 or (total_channels and index >= total_channels)):
+                    raise MetaInfoError(
+                        f"Channel index {index} of the {side} fiber is outside 0..{total_channels}"
+                    )
+            colors[letter] = color_info
+        fibers[side] = FiberInfo(
+            side=side,
+            fiber_id=fiber_id,
+            notes=implantation.get(side, {}).get("notes", None),
+            colors=colors,
+        )
+
+    if require_signals and not fibers:
+        raise MetaInfoError("Signal_Indices has neither a right nor a left table")
+
+    return MetaInfo(
+        path=path,
+        raw=meta_info,
+        light_source=meta_info.get("Fiber", {}).get("light_source", ""),
+        processing_parameters=processing_parameters,
+        fibers=fibers,
+    )
+
+
+def load_meta_info(directory, require_signals=True) -> MetaInfo:
+
+    """
+    Parse and validate the .toml meta info file of a session folder
+    INPUTS:
+        directory: folder holding the .toml file (e.g. <session>/Photometry)
+        require_signals: whether Signal_Indices and the sampling frequency are required
+    OUTPUTS:
+        MetaInfo, cached until the file changes
+    Raises FileNotFoundError without a .toml file and MetaInfoError if it is malformed
+    """
+
+    toml_files = sorted(Path(directory).glob("*.toml"))
+    if not toml_files:
+        raise FileNotFoundError(f"No .toml meta info file in {directory}")
+    path = toml_files[0]
+
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size, require_signals)
+    cached = _meta_info_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        try:
+            parsed = tomli.load(f)
+        except tomli.TOMLDecodeError as err:
+            raise MetaInfoError(f"{path}: {err}") from err
+    try:
+        meta_info = _parse(path, parsed, require_signals)
+    except (AttributeError, TypeError) as err:
+        # a table where a value was expected or vice versa
+        raise MetaInfoError(f"{path}: unexpected structure ({err})") from err
+    except MetaInfoError as err:
+        raise MetaInfoError(f"{path}: {err}") from err
+
+    _meta_info_cache[path] = (signature, meta_info)
+    return meta_info
@@ -0,0 +1,220 @@
+"""
+Readers for raw photometry files that only load what a session uses
+
+MATLAB v7.3 files are HDF5 and are sliced lazily through h5py, uncompressed
+MATLAB v5 matrices are memory-mapped, anything else falls back to scipy.io.
+TDT blocks are read one stream store and channel at a time.
+"""
+
+from __future__ import annotations
+import struct
+import numpy as np
+import scipy.io as spio
+
+
+# MATLAB v5 data element types and array classes (MAT-file format reference)
+_MI_MATRIX = 14
+_MI_DTYPES = {
+    1: "i1", 2: "u1", 3: "i2", 4: "u2", 5: "i4", 6: "u4",
+    7: "f4", 9: "f8", 12: "i8", 13: "u8",
+}
+_MX_DTYPES = {
+    6: "f8", 7: "f4", 8: "i1", 9: "u1", 10: "i2",
+    11: "u2", 12: "i4", 13: "u4", 14: "i8", 15: "u8",
+}
+
+
+def mat_file_version(path) -> int:
+    """MAT-file major version: 0 (v4), 1 (v5 - v7.2) or 2 (v7.3, HDF5)"""
+    return spio.matlab.matfile_version(str(path))[0]
+
+
+def _read_tag(f, endian):
+    # data element tag, handles the small data element format
+    raw = f.read(8)
+    if len(raw) < 8:
+        return None, None, None
+    mtype, nbytes = struct.unpack(endian + "II", raw)
+    if mtype >> 16:
+        # small element: type and size packed in the first 4 bytes, data in the last 4
+        return mtype & 0xFFFF, mtype >> 16, raw[4 : 4 + (mtype >> 16)]
+    return mtype, nbytes, None
+
+
+def _mat5_matrix_layout(path, variable):
+    """
+    Locate the real data of an uncompressed numeric matrix in a v5 MAT-file
+    OUTPUTS:
+        (offset, stored dtype, class dtype, shape) or None if the variable is
+        missing, compressed or not a plain real numeric matrix
+    """
+
+    with open(path, "rb") as f:
+        header = f.read(128)
+        endian = "<" if header[126:128] == b"IM" else ">"
+        while True:
+            start = f.tell()
+            mtype, nbytes, _ = _read_tag(f, endian)
+            if mtype is None:
+                return None
+            end = start + 8 + nbytes
+            if mtype != _MI_MATRIX:
+                # compressed variables can't be mapped, skip to the next element
+                f.seek(end)
+                continue
+
+            # array flags
+            _, _, small = _read_tag(f, endian)
+            flags = struct.unpack(endian + "II", f.read(8)) if small is None else (0, 0)
+            array_class, is_complex = flags[0] & 0xFF, flags[0] & 0x800
+            # dimensions
+            _, dims_bytes, small = _read_tag(f, endian)
+            if small is None:
+                dims = struct.unpack(endian + "%di" % (dims_bytes // 4), f.read(dims_bytes))
+                f.seek(-dims_bytes % 8, 1)
+            else:
+                dims = struct.unpack(endian + "%di" % (dims_bytes // 4), small)
+            # name
+            _, name_bytes, small = _read_tag(f, endian)
+            if small is None:
+                name = f.read(name_bytes)
+                f.seek(-name_bytes % 8, 1)
+            else:
+                name = small
+            if name.decode("latin1") != variable:
+                f.seek(end)
+                continue
+
+            if array_class not in _MX_DTYPES or is_complex:
+                return None
+            # real part
+            data_type, data_bytes, small = _read_tag(f, endian)
+            if small is not None or data_type not in _MI_DTYPES:
+                return None
+            stored = np.dtype(endian + _MI_DTYPES[data_type])
+            if data_bytes != stored.itemsize * int(np.prod(dims)):
+                return None
+            return f.tell(), stored, np.dtype(_MX_DTYPES[array_class]), tuple(dims)
+
+
+def mat_channels_seekable(path, variable: str) -> bool:
+    """Whether read_mat_channels reads channels of the matrix without loading all of it"""
+    return mat_file_version(path) == 2 or _mat5_matrix_layout(path, variable) is not None
+
+
+def read_mat_channels(path, variable: str, channels, block_size=2**20, n_samples=None) -> dict:
+
+    """
+    Read selected rows (channels) of a numeric matrix stored in a MAT-file
+    INPUTS:
+        path: MAT-file path
+        variable: name of the (n_channels, n_samples) matrix, e.g. "data"
+        channels: row indices to read
+        block_size: number of samples copied per block from mapped/HDF5 data
+        n_samples: number of leading samples to read (default: all)
+    OUTPUTS:
+        dict mapping each channel index to its 1-D trace
+    """
+
+    channels = sorted({int(c) for c in channels})
+
+    if mat_file_version(path) == 2:
+        import h5py
+
+        with h5py.File(path, "r") as f:
+            # HDF5 holds the transpose of the MATLAB matrix: (n_samples, n_channels)
+            dataset = f[variable]
+            n_samples = min(dataset.shape[0], n_samples or dataset.shape[0])
+            traces = {c: np.empty(n_samples, dtype=dataset.dtype) for c in channels}
+            for start in range(0, n_samples, block_size):
+                block = dataset[start : min(start + block_size, n_samples), :]
+                for c in channels:
+                    traces[c][start : start + block_size] = block[:, c]
+        return traces
+
+    layout = _mat5_matrix_layout(path, variable)
+    if layout is None:
+        matrix = spio.loadmat(path, variable_names=[variable])[variable]
+        return {c: np.array(matrix[c][:n_samples]) for c in channels}
+
+    offset, stored, dtype, shape = layout
+    mapped = np.memmap(path, dtype=stored, mode="r", offset=offset, shape=shape, order="F")
+    n_samples = min(shape[1], n_samples or shape[1])
+    try:
+        traces = {c: np.empty(n_samples, dtype=dtype) for c in channels}
+        for start in range(0, n_samples, block_size):
+            block = mapped[:, start : min(start + block_size, n_samples)]
+            for c in channels:
+                traces[c][start : start + block_size] = block[c]
+    finally:
+        del mapped
+    return traces
+
+
+def _h5_matlab_value(f, item):
+    # dereference and convert a MATLAB v7.3 value the way pymatreader does
+    value = item[()] if hasattr(item, "shape") else f[item][()]
+    value = np.squeeze(np.asarray(value).T)
+    return value.item() if value.ndim == 0 else value
+
+
+def read_mat73_struct(path, variable: str, fields, indices) -> dict:
+
+    """
+    Lazily read selected elements of a MATLAB v7.3 struct array
+    INPUTS:
+        path: MAT-file path (v7.3)
+        variable: name of the struct array, e.g. "timeSeries"
+        fields: struct fields to read
+        indices: struct array elements to read
+    OUTPUTS:
+        dict mapping each field to {index: value}, so that
+        result[field][index] matches pymatreader.read_mat(path)[variable][field][index]
+    """
+
+    import h5py
+
+    result = {field: {} for field in fields}
+    with h5py.File(path, "r") as f:
+        group = f[variable]
+        for field in fields:
+            refs = group[field]
+            if refs.dtype != h5py.ref_dtype:
+                # 1x1 struct: fields are stored directly
+                value = _h5_matlab_value(f, refs)
+                result[field] = {index: value for index in indices}
+                continue
+            refs = refs[()].T.ravel()
+            for index in indices:
+                result[field][index] = _h5_matlab_value(f, refs[index])
+    return result
+
+
+def read_tdt_channels(block_path, store_channels: dict, t1=0, t2=0, dtype="float32") -> dict:
+
+    """
+    Read selected channels of TDT stream stores
+    INPUTS:
+        block_path: TDT block directory
+        store_channels: {store name: row indices}, e.g. {"Fi1r": [0, 2]}
+        t1, t2: time range to read in seconds (0 reads the whole block)
+        dtype: dtype of the returned traces
+    OUTPUTS:
+        {store name: {row index: 1-D trace}}, rows as in tdt.read_block(...).streams[store].data
+    """
+
+    import tdt
+
+    streams = {}
+    for store, indices in store_channels.items():
+        streams[store] = {}
+        for index in sorted({int(i) for i in indices if i is not None}):
+            # only this store's headers and this channel's data are read, TDT channels are 1-based
+            block = tdt.read_block(
+                block_path, evtype=["streams"], store=store, channel=index + 1, t1=t1, t2=t2
+            )
+            data = block.streams[store].data
+            if data.ndim == 2:
+                data = data[0] if data.shape[0] == 1 else data[index]
+            streams[store][index] = np.asarray(data, dtype=dtype)
+    return streams
@@ -7,6 +7,9 @@ Created on Tue May 19 20:53:07 2020
 import pandas as pd
 import numpy as np
 import typing as T
+import warnings
+
+from workflow.utils.rolling import rolling_mean_std
 
 
 def set_analog_headers(analog_df: pd.DataFrame):
@@ -44,19 +47,22 @@ def set_analog_headers(analog_df: pd.DataFrame):
     return analog_df
 
 
-def handshake_behav_recording_sys(data: pd.DataFrame) -> pd.DataFrame:
-    """now from the perspective of the photometry data, find first incoming and outgoing pulses"""
+def handshake_start(data: pd.DataFrame):
+    """index of the photometry sample where the handshake with the behavior system completes"""
 
     data = data.loc[
         data[data["toBehSys"] == 1].index[0] :
     ]  # confirm recording system is sending signal to behavior
 
-    data = data.loc[data[data["fromBehSys"] == 0].index[0] :].reset_index(
-        drop=True
-    )  # confirm behavior system sends signal back at trial starts
-    # further trim to start when first trial signaled
+    # confirm behavior system sends signal back at trial starts
+    return data[data["fromBehSys"] == 0].index[0]
+
+
+def handshake_behav_recording_sys(data: pd.DataFrame) -> pd.DataFrame:
+    """now from the perspective of the photometry data, find first incoming and outgoing pulses"""
 
-    return data
+    # further trim to start when first trial signaled
+    return data.loc[handshake_start(data) :].reset_index(drop=True)
 
 
 def bins_per_trial_behavior(analog_df: pd.DataFrame):
@@ -82,14 +88,128 @@ def bins_per_trial_photo(photo_df: pd.DataFrame):
     return trial_lengths, trial_starts
 
 
-def resample_and_align(
-    beh_df, photo_df, channels=["grnR", "redR", "grnL", "redL"], by_trial=False
-) -> T.Tuple[pd.DataFrame, float]:
+def find_trial_offset(
+    photo_trial_lengths, behavior_trial_lengths, n_trials, max_lag=30
+) -> T.Tuple[int, float]:
+
+    """finds the trial offset between photometry and behavior from their trial lengths
 
-    """resamples photometry data and aligns with behavior data"""
+    The first n_trials trial lengths of both systems are compared at every offset in
+    range(-max_lag, max_lag): offset i >= 0 pairs photometry trial k with behavior
+    trial k + i, offset i < 0 pairs photometry trial k + |i| with behavior trial k.
+    Pearson correlations of all offsets are computed at once from one (FFT) cross-
+    correlation and prefix sums. Returns the best offset and its correlation, the
+    alignment quality score.
+    """
 
     import scipy.signal as sp_signal
 
+    photo = np.asarray(photo_trial_lengths[:n_trials])
+    behavior = np.asarray(behavior_trial_lengths[:n_trials])
+    n_trials = min(len(photo), len(behavior))
+    photo, behavior = photo[:n_trials], behavior[:n_trials]
+
+    # sum_k photo[k] * behavior[k + lag] over the overlapping trials of every lag
+    # (scipy rounds FFT results back to exact sums for integer trial lengths)
+    products = sp_signal.correlate(behavior, photo, mode="full")
+    all_lags = sp_signal.correlation_lags(n_trials, n_trials, mode="full")
+
+    lags = np.arange(-max_lag, max_lag)
+    valid = np.abs(lags) < n_trials
+    lags = lags[valid]
+    sum_xy = products[lags - all_lags[0]].astype(float)
+
+    # overlapping windows: photometry [max(0, -lag), n - max(0, lag)),
+    # behavior [max(0, lag), n - max(0, -lag))
+    n = n_trials - np.abs(lags)
+    photo_start = np.maximum(0, -lags)
+    behavior_start = np.maximum(0, lags)
+
+    def window_sums(x, start):
+        cumsum = np.concatenate(([0.0], np.cumsum(x, dtype=float)))
+        cumsum2 = np.concatenate(([0.0], np.cumsum(np.square(x, dtype=float))))
+        return cumsum[start + n] - cumsum[start], cumsum2[start + n] - cumsum2[start]
+
+    sum_x, sum_x2 = window_sums(photo, photo_start)
+    sum_y, sum_y2 = window_sums(behavior, behavior_start)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = (n * sum_xy - sum_x * sum_y) / np.sqrt(
+            (n * sum_x2 - sum_x**2) * (n * sum_y2 - sum_y**2)
+        )
+
+    scores = np.full(2 * max_lag, np.nan)
+    scores[valid] = corr
+    best = np.nanargmax(scores)
+    return int(best - max_lag), float(scores[best])
+
+
+def resample_by_trial(photo_values, photo_starts, behavior_starts) -> np.ndarray:
+
+    """resamples photometry samples onto behavior samples trial by trial
+
+    photo_values: (n_photo_samples, n_channels) photometry of the aligned trials
+    photo_starts, behavior_starts: sample index of each trial start in both systems,
+        plus the end of the last trial (same number of trials)
+
+    Behavior time maps piecewise-linearly onto photometry time, with one segment
+    per trial, so clock drift is corrected at every trial start. When a behavior
+    sample spans more than one photometry sample (downsampling), it takes the mean
+    of the linearly interpolated photometry over that span, which anti-aliases.
+    Otherwise (same rate or upsampling) it takes the linearly interpolated
+    photometry at its centre, so equal rates return the photometry unchanged.
+    Everything is vectorised over trials with O(n) memory.
+    """
+
+    photo_values = np.asarray(photo_values, dtype=float)
+    squeeze = photo_values.ndim == 1
+    if squeeze:
+        photo_values = photo_values[:, None]
+    n_photo = len(photo_values)
+    n_behavior = int(behavior_starts[-1])
+
+    def linear(positions):
+        # linearly interpolated photometry at fractional sample positions, with the
+        # first sample, fraction and slope of the segment each position falls in
+        sample = np.clip(np.floor(positions).astype(int), 0, max(n_photo - 2, 0))
+        frac = (positions - sample)[:, None]
+        slope = photo_values[np.minimum(sample + 1, n_photo - 1)] - photo_values[sample]
+        return photo_values[sample] + frac * slope, sample, frac, slope
+
+    # photometry position of the centre and edges of every behavior sample (sample j spans j +- 0.5)
+    centres = np.interp(np.arange(n_behavior), behavior_starts, photo_starts)
+    centres = np.clip(centres, 0, n_photo - 1)
+    edges = np.interp(np.arange(n_behavior + 1) - 0.5, behavior_starts, photo_starts)
+    edges = np.clip(edges, 0, n_photo - 1)
+
+    # antiderivative of the linearly interpolated photometry at the edges
+    cumulative = np.concatenate(
+        (np.zeros((1, photo_values.shape[1])),
+         np.cumsum((photo_values[1:] + photo_values[:-1]) / 2, axis=0))
+    )
+    _, sample, frac, slope = linear(edges)
+    integral = cumulative[sample] + frac * photo_values[sample] + frac**2 / 2 * slope
+
+    width = np.diff(edges)[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        resampled = np.where(
+            width > 1 + 1e-9,
+            np.diff(integral, axis=0) / width,
+            linear(centres)[0],  # spans of at most one sample, e.g. equal rates
+        )
+    return resampled[:, 0] if squeeze else resampled
+
+
+def align_trial_starts(beh_df, photo_df, max_lag=30) -> T.Tuple[np.ndarray, np.ndarray]:
+
+    """matches the trial starts of photometry and behavior data
+
+    max_lag: largest trial offset between the systems' start-ups that is searched
+    Returns the sample index of every matched trial start in photometry and in behavior,
+    plus the end of the last matched trial (same length, photometry sample photo_starts[k]
+    is recorded at behavior sample behavior_starts[k]).
+    """
+
     behavior_trial_lengths, beh_bin_idx = bins_per_trial_behavior(
         beh_df
     )  # get trial starts (enl pulses) for analog
@@ -102,59 +222,51 @@ def resample_and_align(
     shorterList = min(len(photo_bin_idx), len(beh_bin_idx)) - 1
 
     # find offset between photometry and behavior (number of trials between starts)
-    corr_lst = []
-
-    for i in range(-30, 30):  # (makes assumption behavior started first)
-
-        if i < 0:
-            corr_lst.append(
-                np.corrcoef(
-                    photo_trial_lengths[np.abs(i) : shorterList],
-                    behavior_trial_lengths[: shorterList - np.abs(i)],
-                )[1, 0]
-            )
-
-        if i >= 0:
-            corr_lst.append(
-                np.corrcoef(
-                    photo_trial_lengths[: shorterList - i],
-                    behavior_trial_lengths[i:shorterList],
-                )[1, 0]
-            )
-
-    offset = range(-30, 30)[np.argmax(corr_lst)]
-
-    # print(np.corrcoef(photo_trial_lengths[np.max((0, -offset)) : shorterList - np.max((0, offset))],
-    #               behavior_trial_lengths[np.max((0, offset)) : shorterList - np.max((0, -offset))]))
-
-    assert (
-        np.corrcoef(
-            photo_trial_lengths[
-                np.max((0, -offset)) : shorterList - np.max((0, offset))
-            ],
-            behavior_trial_lengths[
-                np.max((0, offset)) : shorterList - np.max((0, -offset))
-            ],
-        )[1, 0]
-        > 0.99999
-    )  # need to set threshold better
+    offset, score = find_trial_offset(
+        photo_trial_lengths, behavior_trial_lengths, shorterList, max_lag=max_lag
+    )
+    assert score > 0.99999  # need to set threshold better
+
+    photo_starts = np.asarray(
+        photo_bin_idx[np.max((0, -offset)) : shorterList - np.max((0, offset)) + 1]
+    )
+    behavior_starts = np.asarray(
+        beh_bin_idx[np.max((0, offset)) : shorterList - np.max((0, -offset)) + 1]
+    )
+    return photo_starts, behavior_starts
+
+
+def resample_and_align(
+    beh_df, photo_df, channels=["grnR", "redR", "grnL", "redL"], by_trial=False, max_lag=30
+) -> T.Tuple[pd.DataFrame, float]:
+
+    """resamples photometry data and aligns with behavior data
+
+    max_lag: largest trial offset between the systems' start-ups that is searched
+    """
+
+    import scipy.signal as sp_signal
+
+    photo_starts, behavior_starts = align_trial_starts(beh_df, photo_df, max_lag=max_lag)
+
+    photo_session_trimmed = photo_df[photo_starts[0] : photo_starts[-1]]
+    behavior_session_trimmed = beh_df[
+        behavior_starts[0] : behavior_starts[-1]
+    ].reset_index(drop=True)
 
     if by_trial:
-        raise NotImplementedError
+        # map every behavior trial onto its photometry trial
+        photo_resample = pd.DataFrame(
+            resample_by_trial(
+                photo_session_trimmed[channels].to_numpy(dtype=float),
+                photo_starts - photo_starts[0],
+                behavior_starts - behavior_starts[0],
+            ),
+            columns=channels,
+        )
 
     else:
         # print("full session resampling")
-        photo_session_trimmed = photo_df[
-            photo_bin_idx[np.max((0, -offset))] : photo_bin_idx[
-                shorterList - np.max((0, offset))
-            ]
-        ]
-        behavior_session_trimmed = beh_df[
-            beh_bin_idx[np.max((0, offset))] : beh_bin_idx[
-                shorterList - np.max((0, -offset))
-            ]
-        ].reset_index(drop=True)
-
         # print(
         #     "downsampling by factor of ",
         #     len(photo_session_trimmed) / len(behavior_session_trimmed),
@@ -167,18 +279,53 @@ def resample_and_align(
             columns=channels,
         )
 
-        aligned_df = pd.concat(
-            [behavior_session_trimmed, photo_resample], axis=1
-        ).reset_index()
-        time_offset = (
-            behavior_session_trimmed["session_clock"].iloc[0]
-            - beh_df["session_clock"].iloc[0]
-        )  # in seconds
-        # print(f"shift into behavior by {time_offset} seconds")
+    aligned_df = pd.concat(
+        [behavior_session_trimmed, photo_resample], axis=1
+    ).reset_index()
+    time_offset = (
+        behavior_session_trimmed["session_clock"].iloc[0]
+        - beh_df["session_clock"].iloc[0]
+    )  # in seconds
+    # print(f"shift into behavior by {time_offset} seconds")
 
     return aligned_df, time_offset
 
 
+def downsample_bins(df: pd.DataFrame, factor: int, mean_columns) -> pd.DataFrame:
+
+    """downsamples a dataframe into bins of factor consecutive rows
+
+    mean_columns are averaged over each bin and every other column takes its maximum
+    (NaNs are skipped). Rows that don't fill a last bin form an incomplete bin. Returns
+    one row per bin, with the other columns followed by mean_columns, like
+    df.groupby(bin_ids).agg({...: np.max, ...: np.mean}).
+    """
+
+    factor = int(factor)
+    n_full_bins, remainder = divmod(len(df), factor)
+    mean_columns = list(mean_columns)
+    columns = [column for column in df.columns if column not in mean_columns] + mean_columns
+
+    def reduce(values, column):
+        # values: (n_bins, samples per bin)
+        skipna = values.dtype.kind in "fc"
+        if column in mean_columns:
+            return np.nanmean(values, axis=1) if skipna else values.mean(axis=1)
+        return np.nanmax(values, axis=1) if skipna else values.max(axis=1)
+
+    downsampled = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # bins of NaNs only stay NaN
+        for column in columns:
+            values = df[column].to_numpy()
+            binned = reduce(values[: n_full_bins * factor].reshape(n_full_bins, factor), column)
+            if remainder:
+                tail = reduce(values[n_full_bins * factor :].reshape(1, remainder), column)
+                binned = np.concatenate((binned, tail))
+            downsampled[column] = binned
+    return pd.DataFrame(downsampled, columns=columns)
+
+
 def normalize(x, window):
 
     r = x.rolling(window=window, center=True)
@@ -195,7 +342,10 @@ def zscore(x, window, rolling=False):
     # z score options: full distribution or sliding window
 
     if rolling:
-        r = x.rolling(window=window, center=True)
+        if isinstance(x, pd.DataFrame):
+            return x.apply(lambda col: zscore(col, window, rolling=True))
+        m, s = rolling_mean_std(x.to_numpy(dtype="float"), window)
+        return (x - m) / s
     else:
         r = x.copy()
 
@@ -0,0 +1,154 @@
+"""
+Local cache of raw photometry channels
+
+The first read of a session converts its selected raw channels to one .npy
+file per channel under ``processed_root_data_dir/raw_cache``, keyed by the
+checksum of the source files. Later reads memory-map these files instead of
+parsing the original MATLAB/TDT files again. The cache is opt-in
+(``dj.config['custom']['raw_cache.enabled']``) and the least recently used
+sessions are evicted once it grows beyond ``raw_cache.max_size_gb``.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import datajoint as dj
+
+from workflow.utils.paths import get_processed_root_data_dir
+
+CHECKSUM_INDEX = "checksums.json"
+
+
+def get_raw_cache_dir():
+    """Cache directory, None if the cache is disabled or has nowhere to live"""
+    if not dj.config.get("custom", {}).get("raw_cache.enabled", False):
+        return None
+    processed_dir = get_processed_root_data_dir()
+    return processed_dir / "raw_cache" if processed_dir else None
+
+
+def _write_atomic(path, write):
+    # write to a temporary file first so concurrent readers never see partial files
+    # returns the number of bytes written
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+        size = f.tell()
+    os.replace(tmp_path, path)
+    return size
+
+
+def file_checksum(path, cache_dir, chunk_size=2**23):
+
+    """
+    blake2b checksum of a file's content
+    Checksums are remembered per (size, mtime) in the cache directory, so an
+    unchanged file is only hashed once
+    """
+
+    path = Path(path)
+    stat = path.stat()
+    signature = [stat.st_size, stat.st_mtime_ns]
+    index_file = cache_dir / CHECKSUM_INDEX
+    try:
+        index = json.loads(index_file.read_text())
+    except (FileNotFoundError, ValueError):
+        index = {}
+    entry = index.get(str(path))
+    if entry and entry["signature"] == signature:
+        return entry["checksum"]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    index[str(path)] = {"signature": signature, "checksum": digest.hexdigest()}
+    _write_atomic(index_file, lambda f: f.write(json.dumps(index).encode()))
+    return digest.hexdigest()
+
+
+def cached_channels(source_files, name, channels, reader):
+
+    """
+    Read raw channels through the cache
+    INPUTS:
+        source_files: files the channels are parsed from (all files of a TDT block)
+        name: variable or store the channels belong to, e.g. "data" or "Fi1r"
+        channels: channel indices to read
+        reader: reader(channels) -> {index: 1-D trace}, called for channels not cached yet
+    OUTPUTS:
+        dict mapping each channel index to its trace (copy-on-write memory maps
+        when served from the cache)
+    """
+
+    channels = sorted({int(c) for c in channels if c is not None})
+    cache_dir = get_raw_cache_dir()
+    if cache_dir is None:
+        return reader(channels)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    session_digest = hashlib.blake2b(digest_size=16)
+    for source_file in sorted(Path(f) for f in source_files):
+        session_digest.update(f"{source_file.name}:{file_checksum(source_file, cache_dir)};".encode())
+    entry_dir = cache_dir / session_digest.hexdigest()
+    entry_dir.mkdir(exist_ok=True)
+
+    def channel_file(index):
+        return entry_dir / f"{name}_{index}.npy"
+
+    missing = [c for c in channels if not channel_file(c).exists()]
+    if missing:
+        for index, trace in reader(missing).items():
+            _write_atomic(channel_file(index), lambda f: np.save(f, np.asarray(trace)))
+        evict(cache_dir, keep=entry_dir)
+    # the entry's mtime records when it was last used
+    os.utime(entry_dir)
+
+    return {c: np.load(channel_file(c), mmap_mode="c") for c in channels}
+
+
+def evict(cache_dir, max_size_gb=None, keep=None):
+
+    """
+    Remove least recently used entries until the cache fits its size budget
+    INPUTS:
+        cache_dir: cache directory, entries are its subdirectories or data files
+        max_size_gb: size budget, defaults to dj.config['custom']['raw_cache.max_size_gb']
+        keep: entry that is never evicted (the one being used)
+    OUTPUTS:
+        size of the cache after eviction, in bytes
+    """
+
+    if max_size_gb is None:
+        max_size_gb = dj.config.get("custom", {}).get("raw_cache.max_size_gb", 100)
+    max_size = max_size_gb * 1024**3
+
+    entries = []
+    for entry in Path(cache_dir).iterdir():
+        try:
+            if entry.is_dir():
+                size = sum(f.stat().st_size for f in entry.iterdir())
+            elif entry.name != CHECKSUM_INDEX and not entry.name.startswith("."):
+                size = entry.stat().st_size
+            else:
+                continue
+            entries.append((entry.stat().st_mtime, size, entry))
+        except FileNotFoundError:
+            # removed by another worker meanwhile
+            continue
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, entry in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_size:
+            break
+        if entry == keep:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
+        total -= size
+    return total
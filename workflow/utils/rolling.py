@@ -0,0 +1,90 @@
+"""
+Rolling window statistics for long photometry traces
+
+Centred rolling mean/std computed from chunked prefix sums, matching
+pandas' ``Series.rolling(wn, center=True)`` to floating point tolerance.
+"""
+
+import numpy as np
+
+
+def _rolling_chunks(x, wn, chunk_size):
+    """
+    Yield (start, stop, mean, var) for blocks of output positions [start, stop)
+    Each block is computed from its own overlapping slice of x, so temporaries
+    scale with chunk_size instead of len(x)
+    """
+
+    n = len(x)
+    lead = wn // 2  # window for output i is x[i - lead : i - lead + wn]
+    first, last = lead, n - wn + lead  # positions with a complete window
+
+    for start in range(first, last + 1, chunk_size):
+        stop = min(start + chunk_size, last + 1)
+        seg = np.asarray(x[start - lead : stop - lead + wn - 1], dtype="float64")
+
+        # shift by the block mean so the prefix sums stay small
+        nan_mask = np.isnan(seg)
+        has_nan = nan_mask.any()
+        center = np.nanmean(seg) if has_nan else seg.mean()
+        seg = seg - center
+        if has_nan:
+            seg[nan_mask] = 0
+
+        s1 = np.concatenate([[0.0], np.cumsum(seg)])
+        s2 = np.concatenate([[0.0], np.cumsum(seg * seg)])
+        del seg
+        sum1 = s1[wn:] - s1[:-wn]
+        sum2 = s2[wn:] - s2[:-wn]
+        del s1, s2
+
+        mean = sum1 / wn
+        var = np.maximum(sum2 - sum1 * mean, 0) / (wn - 1)
+        mean += center
+        if has_nan:
+            # pandas needs wn valid samples in the window
+            counts = np.concatenate([[0], np.cumsum(nan_mask)])
+            incomplete = (counts[wn:] - counts[:-wn]) > 0
+            mean[incomplete] = np.nan
+            var[incomplete] = np.nan
+
+        yield start, stop, mean, var
+
+
+def rolling_mean_std(x, wn, dtype="float64", chunk_size=2**20):
+
+    """
+    Centred rolling mean and (ddof=1) standard deviation in one pass
+    INPUTS:
+        x: 1-D signal
+        wn: window length in samples
+        dtype: dtype of the returned arrays (e.g. float32 to halve memory)
+        chunk_size: number of output samples computed per block
+    OUTPUTS:
+        mean, std: NaN where the window is incomplete, as pandas
+    """
+
+    x = np.asarray(x)
+    mean = np.full(len(x), np.nan, dtype=dtype)
+    std = np.full(len(x), np.nan, dtype=dtype)
+    for start, stop, m, v in _rolling_chunks(x, wn, chunk_size):
+        mean[start:stop] = m
+        std[start:stop] = np.sqrt(v)
+    return mean, std
+
+
+def rolling_zscore(x, wn, dtype="float64", chunk_size=2**20):
+
+    """
+    Centred rolling z-score, (x - rolling mean) / rolling std
+    Same as rolling_mean_std but never holds the full-length mean/std arrays
+    OUTPUTS:
+        z: NaN where the window is incomplete
+    """
+
+    x = np.asarray(x)
+    z = np.full(len(x), np.nan, dtype=dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start, stop, m, v in _rolling_chunks(x, wn, chunk_size):
+            z[start:stop] = (x[start:stop] - m) / np.sqrt(v)
+    return z
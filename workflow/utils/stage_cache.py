@@ -0,0 +1,122 @@
+"""
+Content-addressed cache of demodulation stage outputs
+
+Each stage output (detected carriers, reference fits, bandpassed signals,
+demodulated traces, carrier power) is stored under a hash of its input data
+and stage parameters in ``processed_root_data_dir/stage_cache``. Keys of
+downstream stages include the keys of their inputs, so changing a parameter
+only recomputes the stages that depend on it. The cache is opt-in
+(``dj.config['custom']['stage_cache.enabled']``) and the least recently used
+outputs are evicted once it grows beyond ``stage_cache.max_size_gb``.
+"""
+
+import hashlib
+import os
+import pickle
+import numpy as np
+import datajoint as dj
+
+from workflow.utils.paths import get_processed_root_data_dir
+from workflow.utils.raw_cache import _write_atomic, evict
+
+# size of each cache directory as last scanned plus what this process stored since,
+# the directory is only scanned (and evicted) again once this crosses the budget
+_tracked_size = {}
+EVICTION_HEADROOM = 0.1
+
+
+def get_stage_cache_dir():
+    """Cache directory, None if the cache is disabled or has nowhere to live"""
+    if not dj.config.get("custom", {}).get("stage_cache.enabled", False):
+        return None
+    processed_dir = get_processed_root_data_dir()
+    return processed_dir / "stage_cache" if processed_dir else None
+
+
+def array_digest(x):
+    """blake2b digest of an array's samples, dtype and shape"""
+    x = np.ascontiguousarray(x)
+    digest = hashlib.blake2b(memoryview(x).cast("B"), digest_size=16)
+    digest.update(f"{x.dtype.str}{x.shape}".encode())
+    return digest.hexdigest()
+
+
+def stage_key(stage, *parts):
+
+    """
+    Key of a stage output
+    INPUTS:
+        stage: stage name
+        parts: keys/digests of the stage inputs and the stage parameters
+               (arrays are hashed by content, anything else by its repr)
+    """
+
+    digest = hashlib.blake2b(stage.encode(), digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = array_digest(part)
+        elif isinstance(part, (list, tuple)):
+            part = tuple(p.item() if isinstance(p, np.generic) else p for p in part)
+        elif isinstance(part, np.generic):
+            part = part.item()
+        digest.update(f";{part!r}".encode())
+    return f"{stage}-{digest.hexdigest()}"
+
+
+def load(key):
+    """Cached output of a stage, None if it is not cached"""
+    cache_dir = get_stage_cache_dir()
+    if cache_dir is None:
+        return None
+    for path in (cache_dir / f"{key}.npy", cache_dir / f"{key}.pkl"):
+        try:
+            if path.suffix == ".npy":
+                value = np.load(path, mmap_mode="c")
+            else:
+                with open(path, "rb") as f:
+                    value = pickle.load(f)
+        except FileNotFoundError:
+            continue
+        except (pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+            # truncated, corrupt or stale (pickled class moved) entry: drop it, count a miss
+            path.unlink(missing_ok=True)
+            continue
+        # the file's mtime records when it was last used
+        os.utime(path)
+        return value
+    return None
+
+
+def store(key, value):
+    """Cache the output of a stage, arrays are stored memory-mappable"""
+    cache_dir = get_stage_cache_dir()
+    if cache_dir is None:
+        return
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if isinstance(value, np.ndarray):
+        path = cache_dir / f"{key}.npy"
+        size = _write_atomic(path, lambda f: np.save(f, value))
+    else:
+        path = cache_dir / f"{key}.pkl"
+        size = _write_atomic(path, lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+    max_size_gb = dj.config.get("custom", {}).get("stage_cache.max_size_gb", 50)
+    if cache_dir not in _tracked_size:
+        # first store of this process: one scan (and eviction) to learn the size
+        _tracked_size[cache_dir] = evict(cache_dir, max_size_gb=max_size_gb, keep=path)
+        return
+    _tracked_size[cache_dir] += size
+    if _tracked_size[cache_dir] > max_size_gb * 1024**3:
+        # evict below the budget, so the next scan is only due after another
+        # EVICTION_HEADROOM of the budget has been stored
+        _tracked_size[cache_dir] = evict(
+            cache_dir, max_size_gb=(1 - EVICTION_HEADROOM) * max_size_gb, keep=path
+        )
+
+
+def cached_stage(key, compute):
+    """Output of a stage from the cache, computed (and cached) with compute() on a miss"""
+    value = load(key)
+    if value is None:
+        value = compute()
+        store(key, value)
+    return value